@@ -0,0 +1,147 @@
+# -*- coding: UTF-8 -*-
+"""Benchmark suite for the peid package.
+
+It generates synthetic PE and MS-DOS samples of various sizes, then measures database loading, matching throughput
+ (ep_only, section_start_only and full scan), signature generation and database operations. Results are emitted as
+ JSON so that they can be tracked across releases.
+
+Usage: python benchmarks/benchmark.py [--count N] [--sizes 16384,1048576] [--output results.json]
+"""
+import json
+import os
+import random
+import struct
+import sys
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from peid import find_ep_only_signature, identify_packer, SignaturesDB
+from peid.__info__ import __version__
+from peid.db import DB, SignaturesTree
+
+
+def _randbytes(rnd, n):
+    return rnd.getrandbits(8 * n).to_bytes(n, "little")
+
+
+def _random_signature(sigs, rnd):
+    """ Pick a signature and instantiate its wildcards with random bytes. """
+    return bytes(rnd.randrange(256) if b == "??" else int(b, 16) for b in rnd.choice(sigs))
+
+
+def make_msdos(path, size, rnd, ep_bytes=b""):
+    """ Write a synthetic MS-DOS executable of the given size with its entry point right after its header. """
+    n_reloc, header_paragraphs = 4, 4
+    data = bytearray(_randbytes(rnd, size))
+    pages, last = divmod(size, 512)
+    struct.pack_into("<2s4H10x3H", data, 0, b"MZ", last, pages + (last > 0), n_reloc, header_paragraphs, 0, 4, 28)
+    for i in range(n_reloc):
+        struct.pack_into("<HH", data, 28 + i * 4, rnd.randrange(size >> 4 or 1), 0)
+    data[64:64+len(ep_bytes)] = ep_bytes
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def make_pe(path, size, rnd, ep_bytes=b"", n_sections=4, pe32plus=False):
+    """ Write a synthetic PE executable of the given size, split in sections, with the given bytes at its entry
+         point. """
+    data, pe_offset, align = bytearray(_randbytes(rnd, max(size, 4096))), 64, 512
+    opt_size = 240 if pe32plus else 224
+    raw = (len(data) - 1024) // n_sections // align * align
+    data[:pe_offset] = struct.pack("<2s58xI", b"MZ", pe_offset)
+    struct.pack_into("<4sHHIIIHH", data, pe_offset, b"PE\0\0", [0x14c, 0x8664][pe32plus], n_sections, 0, 0, 0,
+                     opt_size, 0x102)
+    opt = pe_offset + 24
+    data[opt:opt+opt_size] = b"\0" * opt_size
+    struct.pack_into("<H14xI", data, opt, [0x10b, 0x20b][pe32plus], 0x1000)
+    for i in range(n_sections):
+        struct.pack_into("<8sIIII16x", data, opt + opt_size + i * 40, f".sec{i}".encode(), raw, 0x1000 * (i + 1),
+                         raw, 1024 + i * raw)
+    data[1024:1024+len(ep_bytes)] = ep_bytes
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def timeit(func, repeat=3):
+    """ Run func the given number of times and return the best elapsed time in seconds with the last result. """
+    best = float("inf")
+    for _ in range(repeat):
+        t = perf_counter()
+        result = func()
+        best = min(best, perf_counter() - t)
+    return best, result
+
+
+def run(count=20, sizes=(16 << 10, 256 << 10, 1 << 20), repeat=3, db=DB, seed=42):
+    rnd, results = random.Random(seed), {'version': __version__, 'python': sys.version.split()[0], 'count': count,
+                                         'benchmarks': {}}
+    bench = results['benchmarks']
+    with TemporaryDirectory() as tmp:
+        # database loading, cold (compiling the index) and warm (memory-mapping the cached index)
+        with open(db, 'rb') as f:
+            data = f.read()
+        tmpdb = os.path.join(tmp, "userdb.txt")
+        with open(tmpdb, 'wb') as f:
+            f.write(data)
+        tree = SignaturesTree(tmpdb)
+        sigs = [s for _, s, _, ep_only, _ in tree if ep_only and all(b == "??" or "?" not in b for b in s)]
+        def _cold():
+            for p in tree.cache_paths:
+                if os.path.exists(p):
+                    os.remove(p)
+            return SignaturesTree(tmpdb)
+        bench['db_load_cold'] = {'seconds': timeit(_cold, repeat)[0]}
+        bench['db_load_warm'] = {'seconds': timeit(lambda: SignaturesTree(tmpdb), repeat)[0]}
+        # matching throughput per sample size and mode
+        for size in sizes:
+            files = []
+            for i in range(count):
+                ep_bytes = _random_signature(sigs, rnd)
+                files.append(p := os.path.join(tmp, f"sample_{size}_{i}.exe"))
+                if i % 4 == 3:
+                    make_msdos(p, size, rnd, ep_bytes)
+                else:
+                    make_pe(p, size, rnd, ep_bytes, pe32plus=i % 2 == 1)
+            mb = count * size / (1 << 20)
+            for mode, kw in [("ep_only", {}), ("section_start_only", {'ep_only': False, 'sec_start_only': True}),
+                             ("full_scan", {'ep_only': False})]:
+                # warm up (the full-scan automaton is built at first use), then run full scans of large samples once
+                identify_packer(files[0], db=tmpdb, **kw)
+                r = 1 if mode == "full_scan" and size > 256 << 10 else repeat
+                t, res = timeit(lambda: identify_packer(*files, db=tmpdb, **kw), r)
+                bench[f"match_{mode}_{size}"] = {'seconds': t, 'files_per_second': count / t, 'mb_per_second': mb / t,
+                                                 'matched': sum(1 for _, m in res if m)}
+        # signature generation from the samples sharing the same entry point bytes
+        ep_bytes, files = _random_signature(sigs, rnd), []
+        for i in range(count):
+            files.append(p := os.path.join(tmp, f"sig_{i}.exe"))
+            make_pe(p, 16 << 10, rnd, ep_bytes)
+        t, _ = timeit(lambda: find_ep_only_signature(*files), repeat)
+        bench['find_ep_only_signature'] = {'seconds': t, 'files': count}
+        # database operations
+        other = os.path.join(tmp, "other.txt")
+        with open(other, 'wt') as f:
+            f.write("; other database\n\n")
+            for i in range(count * 10):
+                sig = " ".join(f"{b:02X}" for b in _randbytes(rnd, 24))
+                f.write(f"[Synthetic packer {i}]\nsignature = {sig}\nep_only = true\n\n")
+        bench['db_compare'] = {'seconds': timeit(lambda: list(SignaturesDB(tmpdb).compare(other)), repeat)[0]}
+        bench['db_merge'] = {'seconds': timeit(lambda: SignaturesDB(tmpdb).merge(other), repeat)[0]}
+    return results
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description="Benchmark suite for peid")
+    parser.add_argument("-c", "--count", type=int, default=20, help="number of samples per size (default: 20)")
+    parser.add_argument("-d", "--db", default=DB, help="signatures database to be benchmarked (default: embedded DB)")
+    parser.add_argument("-o", "--output", help="path to the JSON output (default: stdout)")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="number of runs, the best is kept (default: 3)")
+    parser.add_argument("-s", "--sizes", default="16384,262144,1048576", help="comma-separated sample sizes in bytes")
+    args = parser.parse_args()
+    results = run(args.count, tuple(map(int, args.sizes.split(","))), args.repeat, args.db)
+    if args.output:
+        with open(args.output, 'wt') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
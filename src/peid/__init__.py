@@ -1,71 +1,352 @@
 # -*- coding: UTF-8 -*-
 import os
+from itertools import accumulate, zip_longest
 
-from .db import SignaturesTree, SignaturesDB
-from .exe import open_exe
+from .db import ResultsCache, SignaturesTree, SignaturesDB
+from .exe import open_exe, Reader
+from .exe.archive import expand, ERRORS
 
-__all__ = ["find_ep_only_signature", "identify_packer", "SignaturesDB"]
+__all__ = ["find_ep_only_signature", "find_signature", "identify_packer", "identify_packer_async",
+           "identify_packer_batch", "mine_signatures", "ResultsCache", "SignaturesDB"]
+
+
+_tree = None
+
+
+def _cache(cache):
+    """ Get the results cache for the given argument, that is, None or False (no cache), True (default location), the
+         path to a cache or a ResultsCache instance ; caches given by path are shared within the process. """
+    if cache is None or cache is False:
+        return
+    return cache if isinstance(cache, ResultsCache) else ResultsCache.get(None if cache is True else cache)
+
+
+def _name(exe):
+    """ Get the name of an executable given as a path, a file object or an in-memory buffer. """
+    if isinstance(exe, (bytes, bytearray, memoryview)):
+        return "<memory>"
+    return getattr(exe, "name", "<stream>" if hasattr(exe, "read") else exe)
+
+
+def _identify(exe, ep_only, sec_start_only, match_all, details=False, normalize=False, cache=None, tree=None,
+              all_kinds=False, source=False, use_mmap=False):
+    """ Match a single executable, returning the error instead of raising it so that a batch can survive it. """
+    from time import perf_counter
+    t = perf_counter()
+    try:
+        r, e = (tree or _tree).match(exe, ep_only, sec_start_only, match_all, details, normalize, _cache(cache),
+                                     all_kinds, source, use_mmap), None
+    except Exception as err:
+        r, e = None, f"{err.__class__.__name__}: {err}"
+    return _name(exe), r, e, perf_counter() - t
+
+
+def _ep_window(path, maxlength):
+    """ Read the bytes at the entry point of a single executable, returning the error instead of raising it. """
+    try:
+        with open_exe(path) as exe:
+            return path, bytes(next(exe.read(maxlength, exe.entrypoint_offset))), None
+    except Exception as e:
+        return path, None, f"{e.__class__.__name__}: {e}"
+
+
+def _skip(exe, error, logger=None):
+    """ Log an executable that could not be matched (e.g. an unreadable archive member) and return its result. """
+    if logger:
+        logger.warning(f"{_name(exe)}: {error.__class__.__name__}: {error}")
+
+
+def _match(exe, db, cache=None, **kwargs):
+    """ Match a single executable with the signatures tree shared within the (possibly worker) process. """
+    return SignaturesTree.get(db).match(exe, cache=_cache(cache), **kwargs)
+
+
+def _init_worker(db):
+    """ Load the signatures tree once per worker process ; the compiled index is memory-mapped, hence shared. """
+    global _tree
+    _tree = SignaturesTree.get(db)
+
+
+def _cluster(windows, similarity):
+    """ Greedily group (path, window) pairs by similarity (portion of equal bytes) with the first window of each
+         cluster. """
+    clusters = []
+    for path, window in windows:
+        for cluster in clusters:
+            ref = cluster[0][1]
+            if sum(a == b for a, b in zip(ref, window)) / max(len(ref), len(window), 1) >= similarity:
+                cluster.append((path, window))
+                break
+        else:
+            clusters.append([(path, window)])
+    return clusters
+
+
+def _consensus(windows):
+    """ Compute in a single pass over the columns of aligned bytes windows the byte of each column if all the windows
+         holding this column agree on it, None (wildcard) otherwise. """
+    consensus = []
+    for column in zip_longest(*windows):
+        values = set(column)
+        values.discard(None)
+        if len(values) == 0:
+            break
+        consensus.append(values.pop() if len(values) == 1 else None)
+    return consensus
+
+
+def _signature(consensus, minlength, maxlength, common_bytes_threshold):
+    """ Derive the longest signature satisfying the threshold of common bytes from a consensus, using the prefix sums of
+         its wildcards. """
+    wildcards = list(accumulate((b is None for b in consensus), initial=0))
+    for length in range(maxlength, minlength - 1, -1):
+        n = min(length, len(consensus))
+        # right-strip "??" tokens up to the minimum length
+        while n > minlength and consensus[n-1] is None:
+            n -= 1
+        if n > 0 and wildcards[n] / n <= 1 - common_bytes_threshold:
+            return consensus[:n]
 
 
 def find_ep_only_signature(*files, minlength=16, maxlength=64, common_bytes_threshold=.5, logger=None):
+    """ Find a signature at the entry point among the given files (see find_signature). """
+    return find_signature(*files, minlength=minlength, maxlength=maxlength,
+                          common_bytes_threshold=common_bytes_threshold, logger=logger)
+
+
+def find_signature(*files, minlength=16, maxlength=64, common_bytes_threshold=.5, sec_start_only=False, logger=None):
     """ Find a signature among the given files.
     
     :param files:                  list of files to be compared in order to deduce a signature
-    :param mainlength:             minimum signature length
+    :param minlength:              minimum signature length
     :param maxlength:              maximum signature length
     :param common_bytes_threshold: minimal portion of bytes common to each file to be considered a valid signature
+    :param sec_start_only:         find a signature at the start of a section instead of at the entry point ; the
+                                    section holding the most common bytes amongst the files is selected
     :return:                       signature string (PEiD format)
     """
-    # load maxlength-series of bytes for each input file
+    # load maxlength-series of bytes at the entry point or at each section start for each input file
     data = []
     for f in files:
         try:
             with open_exe(f) as exe:
-                bytes_from_ep = [f"{b:02X}" for b in list(exe.read(maxlength, exe.entrypoint_offset))[0]]
-            maxlength = max(min(len(bytes_from_ep), maxlength), minlength)
-            data.append(bytes_from_ep)
+                offsets = exe.sections_offsets if sec_start_only else [exe.entrypoint_offset]
+                data.append(list(exe.read(maxlength, *offsets)))
         except (OSError, TypeError, ValueError) as e:
             if logger:
                 logger.debug(f"{f}: {e}")
             else:
                 raise
-    # now determine a signature
-    length = maxlength
-    while length >= minlength:
-        sig = []
-        for i in range(length):
-            for d in data:
-                if i >= len(d):
-                    continue
-                if len(sig) <= i:
-                    sig.append(d[i])
-                elif d[i] != sig[-1]:
-                    sig[-1] = "??"
-                    break
-        # right-strip "??" tokens up to the minimum length
-        while len(sig) > minlength and sig[-1] == "??":
-            sig = sig[:-1]
-        if sig.count("??") / len(sig) <= 1 - common_bytes_threshold:
-            # if it satisfies the condition, then right-strip remaining "??" tokens
-            while len(sig) > minlength and sig[-1] == "??":
-                sig = sig[:-1]
-            return " ".join(sig)
-        length -= 1
-    raise ValueError("Could not find a suitable signature")
-
-
-def identify_packer(*paths_or_buffers, db=None, ep_only=True, sec_start_only=False, match_all=True, logger=None):
+    # now determine a signature for each window position common to all the files and keep the most specific one
+    best = None
+    for i in range(min(map(len, data), default=0)):
+        windows = [d[i] for d in data]
+        sig = _signature(_consensus(windows), minlength, max(min([maxlength] + list(map(len, windows))), minlength),
+                         common_bytes_threshold)
+        if sig and (best is None or sum(b is not None for b in sig) > sum(b is not None for b in best)):
+            best = sig
+    if best is None:
+        raise ValueError("Could not find a suitable signature")
+    return " ".join("??" if b is None else f"{b:02X}" for b in best)
+
+
+def identify_packer(*paths_or_buffers, db=None, ep_only=True, sec_start_only=False, match_all=True, normalize=False,
+                    cache=None, all_kinds=False, archives=False, use_mmap=False, logger=None):
     """ Identify the packer used in a given executable using the given signatures database.
     
-    :param paths_or_buffers: path to the executable file(s) or opened file buffers (io.BufferedReader)
-    :param db:               path to the database
+    The signatures tree is loaded once per process and database (see SignaturesTree.get), then reused by the next calls.
+    
+    :param paths_or_buffers: path to the executable file(s), opened file buffers (io.BufferedReader), seekable
+                              file-like objects (e.g. io.BytesIO) or in-memory buffers (bytes, bytearray, memoryview)
+    :param db:               path to the database, or ordered list of paths to databases compiled into a single
+                              index (see SignaturesTree)
     :param ep_only:          consider only entry point signatures
+    :param normalize:        strip the author ("author"), the version ("version") or both (True) from the names of the
+                              matching packers ; normalized names are precomputed in the compiled index
+    :param cache:            results cache (see ResultsCache), given as an instance, a path or True for the default
+                              location, so that samples already seen are not matched again
+    :param all_kinds:        match the entry point, section start and whole-file signatures at once, opening each
+                              executable once (ep_only and sec_start_only are then ignored, see SignaturesTree.hits)
+    :param archives:         replace the ZIP and TAR archives (possibly compressed or nested) with their members, named
+                              "archive!member" and read without extracting them (see peid.exe.archive.expand) ; a
+                              member that cannot be read or parsed is then logged and matched as None instead of
+                              aborting the scan
+    :param use_mmap:         memory-map the executables given as paths instead of reading them through buffered reads
     :return:                 return the matching packers
     """
-    db, results = SignaturesTree(db, logger=logger), []
+    db, results, cache = SignaturesTree.get(db, logger=logger), [], _cache(cache)
+    if archives:
+        paths_or_buffers = expand(paths_or_buffers)
     if logger:
-        logger.debug(f"ep_only={ep_only}, sec_start_only={sec_start_only}, match_all={match_all}")
+        logger.debug(f"ep_only={ep_only}, sec_start_only={sec_start_only}, match_all={match_all}, "
+                     f"all_kinds={all_kinds}")
     for exe in paths_or_buffers:
-        results.append((getattr(exe, "name", exe), db.match(exe, ep_only, sec_start_only, match_all)))
+        try:
+            r = db.match(exe, ep_only, sec_start_only, match_all, normalize=normalize, cache=cache,
+                         all_kinds=all_kinds, use_mmap=use_mmap)
+        except ERRORS + (TypeError, ) as e:
+            if not archives:
+                raise
+            r = _skip(exe, e, logger)
+        results.append((_name(exe), r))
     return results
 
+
+async def identify_packer_async(*paths_or_buffers, db=None, ep_only=True, sec_start_only=False, match_all=True,
+                                normalize=False, cache=None, all_kinds=False, archives=False, use_mmap=False,
+                                executor=None, logger=None):
+    """ Identify the packer used in the given executables from a coroutine, the matching being offloaded to an executor
+         so that the event loop is not blocked.
+    
+    Only the windows of the executables that are required for matching are read (headers, entry point, section starts),
+     hence in-memory buffers and file-like objects (e.g. samples received over the network) can be scanned without
+     being written to disk.
+    
+    :param paths_or_buffers: path to the executable file(s), seekable file-like objects or in-memory buffers (see
+                              identify_packer)
+    :param db:               path to the database(s) (see identify_packer)
+    :param ep_only:          consider only entry point signatures
+    :param normalize:        strip the author ("author"), the version ("version") or both (True) from the names
+    :param cache:            results cache (see identify_packer)
+    :param all_kinds:        match all the kinds of signatures at once (see identify_packer)
+    :param archives:         replace the archives with their members, skipping the unreadable ones (see identify_packer)
+    :param use_mmap:         memory-map the executables given as paths (see identify_packer)
+    :param executor:         concurrent.futures executor (default: the default executor of the event loop) ; with a
+                              process pool, the executables must be picklable (e.g. paths or bytes)
+    :return:                 return the matching packers
+    """
+    import asyncio
+    from concurrent.futures import ProcessPoolExecutor
+    from functools import partial
+    loop = asyncio.get_running_loop()
+    # load the tree first so that the compiled index is built and cached only once
+    db = (await loop.run_in_executor(None, partial(SignaturesTree.get, db, logger=logger))).path
+    if logger:
+        logger.debug(f"ep_only={ep_only}, sec_start_only={sec_start_only}, match_all={match_all}")
+    # a cache instance cannot be sent to worker processes, hence its path is given instead
+    if isinstance(executor, ProcessPoolExecutor):
+        cache = getattr(cache, "path", cache)
+    if archives:
+        paths_or_buffers = list(expand(paths_or_buffers))
+    match = partial(_match, db=db, ep_only=ep_only, sec_start_only=sec_start_only, match_all=match_all,
+                    normalize=normalize, cache=cache, all_kinds=all_kinds, use_mmap=use_mmap)
+    results = await asyncio.gather(*[loop.run_in_executor(executor, match, exe) for exe in paths_or_buffers],
+                                   return_exceptions=archives)
+    if archives:
+        for i, (exe, r) in enumerate(zip(paths_or_buffers, results)):
+            if isinstance(r, ERRORS + (TypeError, )):
+                results[i] = _skip(exe, r, logger)
+            elif isinstance(r, BaseException):
+                raise r
+    return [(_name(exe), r) for exe, r in zip(paths_or_buffers, results)]
+
+
+def identify_packer_batch(*paths, db=None, ep_only=True, sec_start_only=False, match_all=True, jobs=None, ordered=True,
+                          chunksize=16, details=False, normalize=False, cache=None, all_kinds=False, archives=False,
+                          source=False, use_mmap=False, logger=None):
+    """ Identify the packers used in many executables at once using a pool of worker processes.
+    
+    :param paths:     paths to the executable files, or a single iterable of paths that is then consumed lazily (e.g.
+                       for paths read from a pipe)
+    :param db:        path to the database(s) (see identify_packer)
+    :param ep_only:   consider only entry point signatures
+    :param jobs:      number of worker processes (default: number of CPUs ; 1 means no worker process)
+    :param ordered:   yield the results in the order of the input paths, otherwise as soon as they are available
+    :param chunksize: number of paths sent at once to a worker
+    :param details:   yield (path, hits, elapsed seconds, error) tuples instead, hits being a list of (offset, kind,
+                       name) tuples (see SignaturesTree.hits)
+    :param normalize: strip the author ("author"), the version ("version") or both (True) from the names
+    :param cache:     results cache (see identify_packer), shared by the worker processes through its path
+    :param all_kinds: match all the kinds of signatures at once (see identify_packer)
+    :param archives:  replace the archives with their members (see identify_packer), lazily
+    :param source:    with details, append the path to the database of each signature to the hits
+    :param use_mmap:  memory-map the executables (see identify_packer)
+    :return:          generator of (path, matching packers) tuples ; matching packers is None for a file that could
+                       not be parsed (the error is logged)
+    """
+    from functools import partial
+    from itertools import islice
+    # a single reader (e.g. an archive member) has no read method but is an input, unlike an iterable of paths
+    if len(paths) == 1 and not isinstance(paths[0], (str, bytes, bytearray, memoryview, os.PathLike, Reader)) and \
+       not hasattr(paths[0], "read"):
+        paths = paths[0]
+    if archives:
+        paths = expand(paths)
+    # load the tree in the main process first so that the compiled index is built and cached only once
+    tree = SignaturesTree.get(db, logger=logger)
+    if logger:
+        logger.debug(f"ep_only={ep_only}, sec_start_only={sec_start_only}, match_all={match_all}, jobs={jobs}")
+    identify = partial(_identify, ep_only=ep_only, sec_start_only=sec_start_only, match_all=match_all, details=details,
+                       normalize=normalize, cache=cache if jobs == 1 else getattr(cache, "path", cache),
+                       all_kinds=all_kinds, source=source, use_mmap=use_mmap)
+    def _results(results):
+        for path, result, error, elapsed in results:
+            if error and logger:
+                logger.warning(f"{path}: {error}")
+            yield (path, result, elapsed, error) if details else (path, result)
+    if jobs == 1:
+        yield from _results(map(partial(identify, tree=tree), paths))
+    else:
+        from multiprocessing import Pool
+        with Pool(jobs, _init_worker, (tree.path, )) as pool:
+            # the pool consumes its input eagerly, hence paths are submitted by batches for bounding the memory usage
+            paths, n = iter(paths), chunksize * (jobs or os.cpu_count() or 1) * 16
+            while len(batch := list(islice(paths, n))) > 0:
+                yield from _results([pool.imap_unordered, pool.imap][ordered](identify, batch, chunksize))
+
+
+def mine_signatures(*files, minlength=16, maxlength=64, common_bytes_threshold=.5, prefix=1, min_size=2, db=None,
+                    jobs=None, logger=None):
+    """ Mine entry point signatures from a set of executables packed with possibly different packers.
+    
+    The bytes at the entry point of the samples are bucketed by their first bytes, then grouped in each bucket by
+     similarity, and a signature is derived for each cluster. Each signature is checked against the given database for
+     collisions, that is, existing signatures already matching the samples of the cluster.
+    
+    :param files:                  list of files to be clustered
+    :param minlength:              minimum signature length
+    :param maxlength:              maximum signature length
+    :param common_bytes_threshold: minimal portion of bytes common to each file of a cluster, used both for grouping
+                                    the samples and for validating the signatures
+    :param prefix:                 number of leading bytes used for bucketing the samples (0 means a single bucket)
+    :param min_size:               minimum number of samples for a cluster to yield a signature
+    :param db:                     path to the database for checking collisions
+    :param jobs:                   number of worker processes (default: number of CPUs ; 1 means no worker process)
+    :return:                       generator of (signature string, paths of the samples of the cluster, names of the
+                                    colliding signatures) tuples, by decreasing cluster size ; the samples that cannot
+                                    be read are skipped, their number being logged before the first cluster
+    """
+    from functools import partial
+    tree, buckets = SignaturesTree.get(db, logger=logger), {}
+    def _run(func, items, pool=None):
+        return map(func, items) if pool is None else pool.imap_unordered(func, items, 16)
+    def _mine(pool=None):
+        # windows are read up to the longest signature of the database for checking collisions
+        windows, skipped = {}, 0
+        for path, window, error in _run(partial(_ep_window, maxlength=max(maxlength, tree.max_depth)), files, pool):
+            if error:
+                if logger:
+                    logger.debug(f"{path}: {error}")
+                skipped += 1
+                continue
+            windows[path] = window
+            buckets.setdefault(window[:prefix], []).append((path, window[:maxlength]))
+        if skipped > 0 and logger:
+            logger.warning(f"{skipped} out of {len(files)} samples could not be read and were skipped")
+        clusters = [c for cl in _run(partial(_cluster, similarity=common_bytes_threshold), buckets.values(), pool)
+                    for c in cl if len(c) >= min_size]
+        for cluster in sorted(clusters, key=lambda c: (-len(c), c[0][0])):
+            ws = [w for _, w in cluster]
+            sig = _signature(_consensus(ws), minlength, max(min([maxlength] + list(map(len, ws))), minlength),
+                             common_bytes_threshold)
+            if sig is None:
+                continue
+            collisions = sorted(set(n for p, _ in cluster for n in tree.match_bytes(windows[p], "ep_only")))
+            yield " ".join("??" if b is None else f"{b:02X}" for b in sig), [p for p, _ in cluster], collisions
+    if jobs == 1:
+        yield from _mine()
+    else:
+        from multiprocessing import Pool
+        with Pool(jobs) as pool:
+            yield from _mine(pool)
+
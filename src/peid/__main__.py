@@ -21,6 +21,38 @@ def _setup(parser):
     return args
 
 
+def _files(paths, recursive=False):
+    """ Expand the given paths, yielding the files of the given directories (recursively or not). """
+    from os import scandir, walk
+    from os.path import isdir, join
+    for path in paths:
+        if path == "-":
+            yield from _files(_lines(path), recursive)
+        elif not isdir(path):
+            yield path
+        elif recursive:
+            for root, _, files in walk(path):
+                for f in sorted(files):
+                    yield join(root, f)
+        else:
+            for entry in sorted(scandir(path), key=lambda e: e.name):
+                if entry.is_file():
+                    yield entry.path
+
+
+def _lines(path):
+    """ Yield the non-empty lines of the given file, or of stdin if path is "-", without loading them at once. """
+    import sys
+    f = sys.stdin if path == "-" else open(path)
+    try:
+        for line in f:
+            if (line := line.rstrip("\r\n")):
+                yield line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
 def _valid_file(path):
     from os.path import exists
     if not exists(path):
@@ -28,6 +60,12 @@ def _valid_file(path):
     return path
 
 
+def _valid_path(path):
+    # archive members ("archive!member") are checked when opened
+    from .exe.reader import SEP
+    return path if path == "-" or SEP in path else _valid_file(path)
+
+
 def _valid_percentage(percentage):
     p = float(percentage)
     if not 0. <= p <= 1.:
@@ -51,79 +89,186 @@ def _valid_expression(expr):
 # tool main functions
 def peid():
     """ PEID's main function """
-    import re
+    from itertools import chain, islice
     from time import perf_counter
     parser = _parser("PEiD", "This tool is an implementation in Python of the Packed Executable iDentifier (PEiD) in "
                      "the scope of packing detection for Windows PE files based on signatures",
-                     ["peid program.exe", "peid program.exe -b", "peid program.exe --db custom_sigs_db.txt"])
-    parser.add_argument("path", type=_valid_file, nargs="+", help="path to portable executable")
+                     ["peid program.exe", "peid program.exe -b", "peid program.exe --db custom_sigs_db.txt",
+                      "peid program.exe --db internal_sigs_db.txt --db custom_sigs_db.txt --format csv",
+                      "peid samples/ -r -j 8", "find samples/ -name '*.exe' | peid - -j 8 --format ndjson",
+                      "peid --serve &", "peid program.exe --client", "peid bundle.zip --archives"])
+    parser.add_argument("path", type=_valid_path, nargs="*", help="path to portable executable or folder, or '-' for"
+                        " reading paths from stdin")
     opt = parser.add_argument_group("optional arguments")
     opt.add_argument("-a", "--author", action="store_true", help="include author in the result")
-    opt.add_argument("-d", "--db", default=DB, type=_valid_file,
-                     help="path to the custom database of signatures (default: None ; use the embedded DB)")
     grp = opt.add_mutually_exclusive_group()
+    grp.add_argument("-A", "--all-kinds", action="store_true", help="match entry point, section start and whole-file"
+                     " signatures at once,\n opening each file once (default: False)")
+    opt.add_argument("-c", "--cache", nargs="?", const=True, help="cache the results so that samples already seen are"
+                     " not matched again,\n optionally at the given path (default: None ; no cache)")
+    opt.add_argument("-d", "--db", action="append", type=_valid_file,
+                     help="path to the custom database of signatures, repeated for matching the signatures of\n"
+                          " multiple databases at once, by decreasing priority ; ndjson and csv then include the\n"
+                          " database of each match (default: None ; use the embedded DB)")
     grp.add_argument("-e", "--ep-only", action="store_false",
                      help="only consider signatures from entry point (default: True)")
+    opt.add_argument("-f", "--format", choices=["text", "ndjson", "csv"], default="text",
+                     help="output format ; ndjson and csv include the offset and the kind of each match and the "
+                          "elapsed time\n per file (default: text)")
+    opt.add_argument("-i", "--from-file", type=_valid_path, help="file with paths to be processed, one per line ('-'"
+                     " for stdin)")
+    opt.add_argument("-j", "--jobs", type=int, default=1,
+                     help="number of worker processes (default: 1 ; 0 means the number of CPUs)")
     opt.add_argument("-m", "--match-once", action="store_true", help="match only one signature")
+    opt.add_argument("-r", "--recursive", action="store_true", help="walk input folders recursively (default: False)")
     grp.add_argument("-s", "--section-start-only", dest="sec_start_only", action="store_true",
                      help="consider only signatures from section starts (default: False)")
+    opt.add_argument("-z", "--archives", action="store_true", help="scan the members of ZIP and TAR archives, "
+                     "nested ones included,\n without extracting them (default: False)")
+    opt.add_argument("--mmap", dest="use_mmap", action="store_true", help="memory-map the executables instead of "
+                     "reading them through\n buffered reads (default: False)")
     opt.add_argument("--version", action="store_true", help="include the version in the result")
+    srv = parser.add_argument_group("server arguments")
+    srv = srv.add_mutually_exclusive_group()
+    srv.add_argument("--client", nargs="?", const=True, metavar="SOCKET", help="send the samples to a running server,"
+                     " optionally listening on the given socket\n (default: None ; scan locally)")
+    srv.add_argument("--serve", nargs="?", const=True, metavar="SOCKET", help="keep the signatures loaded and serve"
+                     " scan requests on a Unix socket\n (default: None ; the socket is in XDG_RUNTIME_DIR)")
     extra = parser.add_argument_group("extra arguments")
     extra.add_argument("-b", "--benchmark", action="store_true",
                        help="enable benchmarking, output in seconds (default: False)")
     extra.add_argument("-h", "--help", action="help", help="show this help message and exit")
     extra.add_argument("-v", "--verbose", action="store_true", help="display debug information (default: False)")
     args = _setup(parser)
+    custom, layered = args.db is not None, len(args.db or []) > 1
+    args.db = (args.db or [DB])[0] if len(args.db or []) <= 1 else args.db
+    if args.serve:
+        from .daemon import serve
+        try:
+            serve(None if args.serve is True else args.serve, args.db, args.cache, args.logger)
+        except OSError as e:
+            print(f"[ERROR] {e}\n")
+            return 1
+        return 0
+    if len(args.path) == 0 and args.from_file is None:
+        parser.error("at least one path or --from-file is required")
     # execute the tool
     if args.benchmark:
         t1 = perf_counter()
-    results = identify_packer(*args.path, db=args.db, ep_only=args.ep_only, sec_start_only=args.sec_start_only,
-                              match_all=not args.match_once, logger=args.logger)
-    for pe, r in results:
-        r = r or []
-        if not args.author:
-            r = list(map(lambda x: re.sub(r"\s*\-(\-?\>|\s*by)\s*(.*)$", "", x), r))
-        if not args.version:
-            VER = r"\s*([vV](ersion)?|R)?\s?(20)?\d{1,2}(\.[xX0-9]{1,3}([a-z]?\d)?){0,3}[a-zA-Z\+]?" \
-                  r"(\s*\(?(\s*([Aa]lpha|[Bb]eta|final|lite|LITE|osCE|Demo|DEMO)){1,2}(\s*[a-z]?\d)?\)?)?"
-            VER = re.compile(r"^(.*?)\s+" + VER + r"(\s*[-_\/\~]" + VER + r"){0,3}(\s+\(unregistered\))?")
-            r = list(map(lambda x: re.sub(r"\s+\d+(\s+SE)?$", "", VER.sub(r"\1", x)), r))
-        if len(results) == 1:
-            dt = str(perf_counter() - t1) if args.benchmark else ""
-            if dt != "":
-                r.append(dt)
-            if len(r) > 0:
-                print("\n".join(r))
-            return 0
+    # paths are expanded lazily so that huge lists of files can be piped
+    paths = _files(chain(args.path, [] if args.from_file is None else _lines(args.from_file)), args.recursive)
+    if args.archives:
+        from .exe.archive import expand
+        paths = expand(paths)
+    first = list(islice(paths, 2))
+    single, paths = len(first) == 1 and args.format == "text", chain(first, paths)
+    kwargs = {'db': args.db, 'ep_only': args.ep_only and not args.sec_start_only, 'sec_start_only': args.sec_start_only,
+              'match_all': not args.match_once, 'details': True, 'all_kinds': args.all_kinds, 'source': layered,
+              'use_mmap': args.use_mmap, 'normalize': [[True, "author"], ["version", False]][args.author][args.version]}
+    client = None
+    if args.client:
+        from .daemon import Client
+        try:
+            client = Client(None if args.client is True else args.client)
+        except OSError as e:
+            args.logger.warning(f"Could not reach the server ({e}), scanning locally")
+    if client:
+        # without --db, the server matches with its own database
+        results = client.identify(paths, **{**kwargs, 'db': args.db if custom else None})
+    else:
+        results = identify_packer_batch(paths, jobs=args.jobs or None, cache=args.cache, logger=args.logger, **kwargs)
+    if args.format == "csv":
+        import csv
+        from sys import stdout
+        writer = csv.writer(stdout)
+        writer.writerow(["path", "name", "kind", "offset", "time", "error"] + ["source"] * layered)
+    elif args.format == "ndjson":
+        from msgspec.json import encode
+        from sys import stdout
+    for pe, hits, dt, error in results:
+        # errors are logged by identify_packer_batch when scanning locally, hence only the ones of the server here
+        if client and error:
+            args.logger.warning(f"{pe}: {error}")
+        # a single hit is returned when matching once
+        hits = [] if hits is None else hits if isinstance(hits, list) else [hits]
+        # when matching multiple databases, the source database is appended to the hits
+        hits = [(o, kind or "full", n, *src) for o, kind, n, *src in hits]
+        if args.format == "csv":
+            for o, kind, n, *src in hits or [("", "", "") + ("", ) * layered]:
+                writer.writerow([pe, n, kind, o, f"{dt:.6f}", error or ""] + src)
+        elif args.format == "ndjson":
+            matches = [{'name': n, 'kind': kind, 'offset': o} for o, kind, n, *_ in hits]
+            if layered:
+                for m, h in zip(matches, hits):
+                    m['source'] = h[3]
+            stdout.buffer.write(encode({'path': pe, 'matches': matches, 'time': dt, 'error': error}))
+            stdout.buffer.write(b"\n")
         else:
+            r = [h[2] for h in hits]
+            if single:
+                if args.benchmark:
+                    r.append(str(perf_counter() - t1))
+                if len(r) > 0:
+                    print("\n".join(r))
+                return 0
             print(f"{pe} {','.join(r)}")
-    dt = str(perf_counter() - t1) if args.benchmark else ""
-    if dt != "":
-        print(dt)
+        if args.format != "text":
+            stdout.flush()
+    if client:
+        client.close()
+    elif args.cache and args.jobs == 1:
+        args.logger.debug(f"Results cache: {ResultsCache.get(None if args.cache is True else args.cache).stats}")
+    if args.benchmark:
+        from sys import stderr, stdout
+        print(perf_counter() - t1, file=[stderr, stdout][args.format == "text"])
     return 0
 
 
 def peiddb():
     """ Additional tool for inspecting a database of signatures """
     parser = _parser("PEiD-DB", "This tool aims to inspect the database of signatures of the Packed Executable "
-                     "iDentifier (PEiD)", ["peid-db --filter UPX", "peid-db --db custom-userdb.txt --filter '(?i)upx'"])
+                     "iDentifier (PEiD)", ["peid-db --filter UPX", "peid-db --db custom-userdb.txt --filter '(?i)upx'",
+                                           "peid-db --minimize", "peid-db --minimize --remove --output minimized.txt"])
     opt = parser.add_argument_group("optional arguments")
     opt.add_argument("-d", "--db", default=DB, type=_valid_file,
                      help="path to the custom database of signatures (default: None ; use the embedded DB)")
     opt.add_argument("-f", "--filter", help="pattern for filtering signatures (default: None ; display all)")
+    opt.add_argument("-m", "--minimize", action="store_true", help="report the duplicate, subsumed, shadowed and "
+                     "degenerate signatures instead of filtering\n (NB: with --output, the subsumed ones are removed, "
+                     "and the degenerate ones with --remove)")
     opt.add_argument("-o", "--output", help="path to write the signatures database to (default: None)")
     opt.add_argument("-r", "--remove", action="store_true", help="remove the filtered signatures (default: False)")
     opt.add_argument("-s", "--size", type=_valid_expression, help="size expression for filtering signatures "
                                                                   "(default: None ; display all)")
+    opt.add_argument("-w", "--max-wildcards", type=_valid_percentage, default=.5, help="maximum proportion of wildcards"
+                     " for a signature not to be degenerate, with --minimize ; 0 <= x <= 1 (default: .5)")
     extra = parser.add_argument_group("extra arguments")
     extra.add_argument("-h", "--help", action="help", help="show this help message and exit")
     args = _setup(parser)
     db = SignaturesDB(args.db)
-    c = 0
-    for sig in db.filter(args.filter, size=args.size, remove=args.remove):
-        print(sig, end="")
-        c += 1
-    print(f"{c} signatures {['filtered', 'removed'][args.remove and args.output is not None]}")
+    if args.minimize:
+        from collections import Counter
+        remove = (["subsumed"] + ["degenerate"] * args.remove) if args.output else []
+        reasons, removed, nodes, wildcards = Counter(), set(), 0, 0
+        for reason, name, sig, kind, other, n, w in db.minimize(args.max_wildcards, remove):
+            print(f"[{reason}] {name} ({kind or 'anywhere'}): {sig}" + (f" <- {other}" if other else "") +
+                  f" ; {n} nodes, {w} wildcard branches")
+            reasons[reason] += 1
+            # a signature can be reported for multiple reasons
+            if reason in remove and (kind, sig) not in removed:
+                removed.add((kind, sig))
+                nodes, wildcards = nodes + n, wildcards + w
+        summary = ", ".join(f"{n} {r}" for r, n in reasons.items()) or "none"
+        print(f"{sum(reasons.values())} signatures reported ({summary})")
+        if len(remove) > 0:
+            print(f"{len(removed)} signatures removed, saving at least {nodes} nodes and {wildcards}"
+                  f" wildcard branches")
+    else:
+        c = 0
+        for sig in db.filter(args.filter, size=args.size, remove=args.remove):
+            print(sig, end="")
+            c += 1
+        print(f"{c} signatures {['filtered', 'removed'][args.remove and args.output is not None]}")
     if args.output:
         db.dump(args.output)
         print(f"new database saved to '{args.output}'")
@@ -133,19 +278,32 @@ def peidsig():
     """ Additional tool for creating signatures """
     parser = _parser("PEiD-Sig", "This tool aims to create signatures for the Packed Executable iDentifier (PEiD)",
                      ["peid-sig *.exe", "peid-sig *.exe --db path/to/userdb.txt --packer PE-Packer",
-                      "peid-sig prg1.exe prg2.exe prg3.exe --packer PE-Packer --version v1.0 --author dhondta"])
-    parser.add_argument("path", type=_valid_file, nargs="+", help="path to packed portable executables")
+                      "peid-sig *.exe --section-start-only --packer PE-Packer",
+                      "peid-sig prg1.exe prg2.exe prg3.exe --packer PE-Packer --version v1.0 --author dhondta",
+                      "peid-sig corpus/ -r --mine -j 8"])
+    parser.add_argument("path", type=_valid_file, nargs="+", help="path to packed portable executables or folders")
     sig = parser.add_argument_group("signature arguments")
     sig.add_argument("-m", "--min-length", type=int, default=16, help="minimum length of bytes to be considered for the"
                      " signature (default: 16)")
     sig.add_argument("-M", "--max-length", type=int, default=64, help="maximum length of bytes to be considered for the"
                      " signature (default: 64)")
+    sig.add_argument("-s", "--section-start-only", dest="sec_start_only", action="store_true",
+                     help="find a signature at section starts instead of the entry point (default: False)")
     sig.add_argument("-t", "--bytes-threshold", type=_valid_percentage, default=.5, help="proportion of common bytes"
                      " to be considered from the samples ; 0 <= x <= 1 (default: .5)")
+    mine = parser.add_argument_group("mining arguments")
+    mine.add_argument("--mine", action="store_true", help="cluster the samples and find one entry point signature per"
+                      " cluster\n (NB: with --db and --packer, only the signatures without collision are saved)")
+    mine.add_argument("-j", "--jobs", type=int, default=0,
+                      help="number of worker processes (default: 0 ; means the number of CPUs)")
+    mine.add_argument("--min-size", type=int, default=2, help="minimum number of samples per cluster (default: 2)")
+    mine.add_argument("--prefix", type=int, default=1,
+                      help="number of leading bytes for bucketing the samples (default: 1)")
     opt = parser.add_argument_group("optional arguments")
     opt.add_argument("-a", "--author", help="author of the signature")
     opt.add_argument("-d", "--db", help="target signatures database")
     opt.add_argument("-p", "--packer", help="packer name for the new signature")
+    opt.add_argument("-r", "--recursive", action="store_true", help="walk input folders recursively (default: False)")
     opt.add_argument("-v", "--version", help="packer version to be mentioned in the signature\n\nNB: if no parameter or"
                      " at least packer's name is given, only the signature itself is output ;\n     otherwise, a PEiD-"
                      "formatted signature is displayed\n    in addition, if --db is defined, the signature is saved")
@@ -153,23 +311,45 @@ def peidsig():
     extra.add_argument("-h", "--help", action="help", help="show this help message and exit")
     extra.add_argument("--verbose", action="store_true", help="display debug information (default: False)")
     args = _setup(parser)
+    paths = list(_files(args.path, args.recursive))
+    def _format(packer, s, sec_start_only=False):
+        n = packer
+        if args.version:
+            n += " " + args.version
+        if args.author:
+            n += " -> " + args.author
+        return "[%s]\nsignature = %s\n%s = true" % (n, s, ["ep_only", "section_start_only"][sec_start_only])
+    db = SignaturesDB(args.db, logger=args.logger) if args.db and args.packer else None
+    if args.mine:
+        new = []
+        for i, (s, members, collisions) in enumerate(mine_signatures(*paths, minlength=args.min_length,
+                                                     maxlength=args.max_length, prefix=args.prefix,
+                                                     common_bytes_threshold=args.bytes_threshold,
+                                                     min_size=args.min_size, db=args.db, jobs=args.jobs or None,
+                                                     logger=args.logger), 1):
+            print(f"; cluster {i}: {len(members)} samples ({100 * len(members) / len(paths):.1f}%) ; collisions: "
+                  f"{', '.join(collisions) or 'none'}")
+            if args.packer:
+                if db and len(collisions) == 0:
+                    new.append((f"{args.packer} #{i}", s.split(), True, False, args.author, args.version))
+                s = _format(f"{args.packer} #{i}", s)
+            print(s + "\n")
+        if len(new) > 0:
+            db.set_many(new)
+            db.dump()
+        return 0
     try:
-        s = find_ep_only_signature(*args.path, minlength=args.min_length, maxlength=args.max_length,
-                                   common_bytes_threshold=args.bytes_threshold, logger=args.logger)
+        s = find_signature(*paths, minlength=args.min_length, maxlength=args.max_length,
+                           common_bytes_threshold=args.bytes_threshold, sec_start_only=args.sec_start_only,
+                           logger=args.logger)
     except ValueError:
         print("[ERROR] Could not find a suitable signature\n")
         return 1
     if args.packer:
-        n = args.packer
-        if args.version:
-            n += " " + args.version
-        if args.author:
-            n += " -> " + args.author
-        if args.db:
-            db = SignaturesDB(args.db, logger=args.logger)
-            db.set(args.packer, s, True, args.author, args.version)
+        if db:
+            db.set(args.packer, s.split(), not args.sec_start_only, args.sec_start_only, args.author, args.version)
             db.dump()
-        s = "[%s]\nsignature = %s\nep_only = true" % (n, s)
+        s = _format(args.packer, s, args.sec_start_only)
     print(s)
     return 0
 
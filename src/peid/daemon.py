@@ -0,0 +1,182 @@
+# -*- coding: UTF-8 -*-
+import os
+import struct
+from os.path import abspath, exists, join
+
+from .db import CACHE_DIR, SignaturesTree
+
+
+__all__ = ["serve", "Client", "SOCKET"]
+
+
+LENGTH = struct.Struct(">I")
+SOCKET = join(os.environ.get("XDG_RUNTIME_DIR") or CACHE_DIR, "peid.sock")
+
+
+def _recv(f):
+    """ Read a length-prefixed MessagePack message from a socket file, returning None at the end of the stream. """
+    from msgspec.msgpack import decode
+    if len(header := f.read(LENGTH.size)) < LENGTH.size:
+        return
+    return decode(f.read(LENGTH.unpack(header)[0]))
+
+
+def _send(f, message):
+    """ Write a length-prefixed MessagePack message to a socket file. """
+    from msgspec.msgpack import encode
+    data = encode(message)
+    f.write(LENGTH.pack(len(data)) + data)
+
+
+def serve(path=None, db=None, cache=None, logger=None):
+    """ Serve scan requests over a Unix socket until interrupted, keeping the signatures trees loaded (see
+         SignaturesTree.get) so that the latency of a request is the matching time only.
+    
+    Each connection carries a sequence of requests, each one being answered in turn with the result of the matching.
+     Requests hold either the path to a sample ("path") or its bytes ("data"), and optionally the database ("db", the
+     one of the server by default) and the matching options (ep_only, section_start_only, match_all, normalize,
+     all_kinds, source, use_mmap) ; see Client.
+    
+    :param path:   path to the Unix socket, only accessible to the current user (default: SOCKET)
+    :param db:     path to the database to be loaded at startup and used by the requests that do not name one (other
+                    databases are loaded at their first request)
+    :param cache:  results cache shared by the requests (see identify_packer)
+    :param logger: logger for reporting the requests
+    """
+    import signal
+    import socket
+    import stat
+    import threading
+    from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
+    from . import _cache, _identify
+    path, cache = abspath(path or SOCKET), _cache(cache)
+    def _handle(request):
+        try:
+            tree = SignaturesTree.get(request.get('db', db), logger=logger)
+            exe = request['data'] if 'data' in request else request['path']
+        except Exception as e:
+            return {'hits': None, 'error': f"{e.__class__.__name__}: {e}", 'time': 0.}
+        name, hits, error, dt = _identify(exe, request.get('ep_only', True), request.get('section_start_only', False),
+                                          request.get('match_all', True), True, request.get('normalize', False),
+                                          cache, tree, request.get('all_kinds', False), request.get('source', False),
+                                          request.get('use_mmap', False))
+        if logger:
+            logger.debug(f"{name}: {error or hits} ({dt:.6f}s)")
+        return {'hits': hits, 'error': error, 'time': dt}
+    class _Handler(StreamRequestHandler):
+        def handle(self):
+            while (request := _recv(self.rfile)) is not None:
+                _send(self.wfile, _handle(request))
+                self.wfile.flush()
+    # a socket left by a server that was killed is replaced, unlike the one of a running server or any other file
+    if exists(path):
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            raise OSError(f"{path} exists and is not a socket")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            try:
+                s.connect(path)
+                raise OSError(f"A server is already listening on {path}")
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.remove(path)
+    SignaturesTree.get(db, logger=logger)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    umask = os.umask(0o077)
+    try:
+        server = ThreadingUnixStreamServer(path, _Handler)
+    finally:
+        os.umask(umask)
+    server.daemon_threads = True
+    # SIGTERM stops the server like SIGINT does, that is, removing its socket
+    if threading.current_thread() is threading.main_thread():
+        def _stop(signum, frame):
+            raise KeyboardInterrupt
+        signal.signal(signal.SIGTERM, _stop)
+        signal.signal(signal.SIGINT, _stop)
+    if logger:
+        logger.info(f"Serving on {path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+class Client:
+    """ Client of a scan server (see serve), sending requests over a single connection. """
+    def __init__(self, path=None, timeout=None):
+        import socket
+        self.path = path or SOCKET
+        self.__socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.__socket.settimeout(timeout)
+        try:
+            self.__socket.connect(self.path)
+        except OSError:
+            self.__socket.close()
+            raise
+        self.__file = self.__socket.makefile("rwb")
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, type, value, traceback):
+        self.close()
+    
+    def __request(self, exe, db, options):
+        """ Build the request for a sample given as a path, an in-memory buffer or a file-like object ; paths are made
+             absolute as the server may run in another directory. """
+        from . import _name
+        if isinstance(exe, (bytes, bytearray, memoryview)):
+            request = {'data': bytes(exe)}
+        elif hasattr(exe, "read"):
+            exe.seek(0)
+            request = {'data': exe.read()}
+        else:
+            request = {'path': abspath(exe)}
+        if db:
+            request['db'] = abspath(db) if isinstance(db, (str, os.PathLike)) else [abspath(p) for p in db]
+        request.update(options)
+        return _name(exe), request
+    
+    def close(self):
+        self.__file.close()
+        self.__socket.close()
+    
+    def identify(self, *paths_or_buffers, db=None, ep_only=True, sec_start_only=False, match_all=True, details=False,
+                 normalize=False, all_kinds=False, source=False, use_mmap=False, pipeline=64):
+        """ Identify the packers used in the given executables through the server, yielding the results in the order
+             of the inputs (see identify_packer_batch for the arguments and the results).
+        
+        Up to pipeline requests are sent before reading the first response so that the round trips overlap.
+        """
+        from collections import deque
+        if len(paths_or_buffers) == 1 and not isinstance(paths_or_buffers[0], (str, bytes, bytearray, memoryview,
+                                                                               os.PathLike)) and \
+           not hasattr(paths_or_buffers[0], "read"):
+            paths_or_buffers = paths_or_buffers[0]
+        options = {'ep_only': ep_only, 'section_start_only': sec_start_only, 'match_all': match_all,
+                   'normalize': normalize, 'all_kinds': all_kinds, 'source': source, 'use_mmap': use_mmap}
+        pending = deque()
+        def _response():
+            name, r = pending.popleft(), _recv(self.__file)
+            if r is None:
+                raise ConnectionError("The server closed the connection")
+            hits = r['hits']
+            # (offset, kind, name[, source]) hits are received as lists, a single one when matching once a single kind
+            if hits is not None:
+                single = not match_all and not all_kinds
+                hits = tuple(hits) if single else [tuple(h) for h in hits]
+                if not details:
+                    hits = hits[2] if single else [h[2] for h in hits]
+            return (name, hits, r['time'], r['error']) if details else (name, hits)
+        for exe in paths_or_buffers:
+            name, request = self.__request(exe, db, options)
+            _send(self.__file, request)
+            pending.append(name)
+            if len(pending) >= pipeline:
+                self.__file.flush()
+                yield _response()
+        self.__file.flush()
+        while pending:
+            yield _response()
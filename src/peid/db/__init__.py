@@ -1,129 +1,509 @@
 # -*- coding: UTF-8 -*-
+import os
 import re
-from os.path import basename, dirname, join
+from os.path import basename, dirname, expanduser, join
+from threading import Lock
 
+from .automaton import Automaton
+from .cache import ResultsCache
+from .index import Index, KINDS, VARIANTS, VERSION as INDEX_VERSION
+from .journal import Journal, JournaledIndex
+from .parser import parse
 from ..exe import open_exe
+from ..exe.pe import MalformedPE
 
 
-__all__ = ["DB", "SignaturesDB", "SignaturesTree"]
+__all__ = ["DB", "ResultsCache", "SignaturesDB", "SignaturesTree"]
 
 
 __log = lambda l, m, lvl="debug": getattr(l, lvl)(m) if l else None
+CACHE_DIR = join(os.environ.get("XDG_CACHE_HOME") or join(expanduser("~"), ".cache"), "peid")
+CHUNK_SIZE = 1 << 20
+COMPACTION = 256
 DB = join(dirname(__file__), "userdb.txt")
-SIG = re.compile(r"\[(.*?)\]\s+?signature\s*=\s*(.*?)((?:\s+\?\?)*)\s*ep_only\s*=\s*(\w+)"
-                 r"(?:\s*section_start_only\s*=\s*(\w+)|)", re.S)
+
+
+_TREES, _TREES_LOCK = {}, Lock()
+
+
+def _fingerprint(path, digest=False):
+    """ Compute the fingerprint of a database, that is, its size, its modification time and (optionally, as this
+         requires reading the file) the SHA256 digest of its content. The fingerprint of a list of databases combines
+         theirs. """
+    from hashlib import sha256
+    if not isinstance(path, str):
+        fingerprints, h = [_fingerprint(p, digest) for p in path], sha256()
+        for p, (_, _, d) in zip(path, fingerprints):
+            h.update(p.encode() + b"\0" + d)
+        return sum(f[0] for f in fingerprints), sum(f[1] for f in fingerprints) & ((1 << 64) - 1), \
+            h.digest() if digest else b""
+    st = os.stat(path)
+    if digest:
+        with open(path, 'rb') as f:
+            digest = sha256(f.read()).digest()
+    return st.st_size, st.st_mtime_ns, digest or b""
+
+
+def _load(path, encoding="utf-8", logger=None):
+    """ Parse a database into a dictionary of signatures keyed by their bytes, with its header comments and the
+         signatures overridden by a next one with the same bytes, without compiling its index. """
+    signatures, comments, duplicates = {}, [], []
+    for fields in parse(path, encoding, comments, logger):
+        if (sig := tuple(fields[1])) in signatures:
+            duplicates.append(signatures[sig])
+        signatures[sig] = fields[:5]
+    return signatures, comments, duplicates
+
+
+def _paths(path):
+    """ Normalize the path to a database, or an ordered list of paths to databases (see SignaturesTree), a single
+         path being returned as a string and multiple paths as a tuple. """
+    if path is None or isinstance(path, (str, os.PathLike)):
+        return os.path.abspath(expanduser(path or DB))
+    paths = tuple(os.path.abspath(expanduser(p)) for p in path)
+    return paths[0] if len(paths) == 1 else paths
+
+
+def _variant(normalize):
+    """ Get the index of the name variant (see VARIANTS) for the given normalization ; normalize is either False (raw
+         names), "author" (without author), "version" (without version) or True (without both). """
+    try:
+        return VARIANTS.index((normalize in [True, "author"], normalize in [True, "version"]))
+    except ValueError:
+        raise ValueError(f"Bad normalization '{normalize}'") from None
 
 
 class SignaturesTree:
-    """ Lightweight class for loading signatures search tree and matching signatures. """
+    """ Lightweight class for loading signatures search tree and matching signatures.
+    
+    Matching does not alter the state of the tree, hence an instance can be shared between threads ; see
+     SignaturesTree.get for getting an instance shared within the process.
+    
+    Given an ordered list of databases, a single index is compiled from all of them, recording the database each
+     signature comes from (see hits), so that a sample is matched once against all the databases. A signature (same kind
+     and bytes) of a database shadows the ones of the next databases.
+    
+    Edits of a single database can be applied to its compiled index without rebuilding it (see update) ; they are
+     journaled next to the cached index, so that the next loads apply them too, until the index gets compacted.
+    """
     def __init__(self, path=None, encoding="utf-8", cache=True, keep_trailing_wildcards=False, logger=None):
-        from os.path import abspath, exists, expanduser
+        from hashlib import sha1
+        from os.path import exists
         self.encoding, self.keep_trailing_wildcards, self.logger = encoding, keep_trailing_wildcards, logger
-        self.path = path = abspath(expanduser(path or DB))
-        self.json = join(dirname(path), f".{basename(path).replace('.','_')}{['','_tw'][keep_trailing_wildcards]}.json")
-        if exists(self.json):
-            from msgspec.json import decode
-            with open(self.json, 'rb') as f:
-                self.__tree = decode(f.read())
+        self.path = path = _paths(path)
+        self.paths = [path] if isinstance(path, str) else list(path)
+        self.__automaton, self.__compaction, self.__lock = None, None, Lock()
+        tw = ['', '_tw'][keep_trailing_wildcards]
+        if isinstance(path, str):
+            # the compiled index is cached next to the database or, if not possible, in the user's cache directory
+            name = f"{basename(path).replace('.','_')}{tw}.idx"
+            self.cache_paths = [join(dirname(path), f".{name}"),
+                                join(CACHE_DIR, f"{sha1(path.encode()).hexdigest()[:16]}_{name}")]
         else:
-            if not exists(path):
-                with open(path, 'wt') as f:
+            self.cache_paths = [join(CACHE_DIR, f"{sha1('|'.join(path).encode()).hexdigest()[:16]}_layered{tw}.idx")]
+        self.cache_path = None
+        for p in self.paths:
+            if not exists(p):
+                with open(p, 'wt') as f:
                     f.write("; 0 signature in list")
-            self.__load(path, encoding, cache)
+        fingerprint, digest = _fingerprint(path), []
+        def _valid(source):
+            # the cache is valid if the database was not touched or if its content did not change anyway
+            if tuple(source[:2]) == fingerprint[:2]:
+                return True
+            if len(digest) == 0:
+                digest.append(_fingerprint(path, True)[2])
+            return source[2] == digest[0]
+        if cache:
+            for p in self.cache_paths:
+                try:
+                    index = Index.load(p)
+                except (OSError, ValueError):
+                    continue
+                if _valid(index.source):
+                    self.__index, self.cache_path = index, p
+                    return
+                # an outdated index is brought up to date with its journal if the latter leads to the database as is
+                if isinstance(path, str) and (journal := Journal(p).read(index)) is not None and _valid(journal[1]):
+                    self.__index, self.cache_path = JournaledIndex(index, *journal, path), p
+                    return
+                if self.logger:
+                    self.logger.debug(f"Outdated compiled index: {p}")
+        self.__load(path, encoding, cache)
+    
+    @classmethod
+    def get(cls, path=None, keep_trailing_wildcards=False, logger=None):
+        """ Get the instance shared within the process for the given database, loading it only the first time or when
+             the database was modified since then (thread-safe).
+        
+        :param path:                    path to the database, or ordered list of paths to databases
+        :param keep_trailing_wildcards: whether trailing "??" tokens of the signatures are to be kept
+        :param logger:                  logger bound to the instance when it gets loaded
+        :return:                        signatures tree instance
+        """
+        from os.path import getmtime
+        key = (cls, _paths(path), keep_trailing_wildcards)
+        with _TREES_LOCK:
+            try:
+                mtime, tree = _TREES[key]
+                if mtime == [getmtime(p) for p in tree.paths]:
+                    return tree
+            except (KeyError, OSError):
+                pass
+            tree = cls(key[1], keep_trailing_wildcards=keep_trailing_wildcards, logger=logger)
+            _TREES[key] = ([getmtime(p) for p in tree.paths], tree)
+            return tree
     
     def __iter__(self):
-        with open(self.path, encoding=self.encoding) as f:
-            data = f.read()
-        for name, signature, trailing_wildcards, ep_only, sec_start_only in SIG.findall(data):
-            if ep_only == "true" and sec_start_only == "true":
-                raise ValueError("Bad signature ; ep_only and section_start_only are mutually exclusive")
-            yield name, \
-                  signature.replace("\n", "").split(), \
-                  trailing_wildcards, \
-                  ep_only == "true", \
-                  sec_start_only == "true"
-    
-    def __load(self, path, encoding="utf-8", cache=True):
-        """ Load the signatures database into a tree. """
-        self.__tree = {'': {}, 'ep_only': {}, 'section_start_only': {}, 'max_depth': 0}
-        for name, signature, trailing_wildcards, ep_only, sec_start_only in self:
-            tree = self.__tree['ep_only' if ep_only else 'section_start_only' if sec_start_only else '']
-            if self.keep_trailing_wildcards:
-                signature += trailing_wildcards.strip().split()
-            l = len(signature)
-            if l > self.__tree['max_depth']:
-                self.__tree['max_depth'] = l
-            for byte in signature:
-                tree.setdefault(byte, {})
-                tree = tree[byte]
-            tree['value'] = name
-        if cache:
-            from msgspec.json import encode
-            with open(self.json, 'wb') as f:
-                f.write(encode(self.__tree))
+        for _, fields in self.__signatures():
+            yield fields
     
-    def match(self, pe, ep_only=True, sec_start_only=False, match_all=True):
-        """ Match a given bytes sequence against the search tree. """
-        if ep_only and sec_start_only:
-            raise ValueError("ep_only and section_start_only are mutually exclusive")
-        matches, n_bytes = [], self.__tree['max_depth']
-        def _match(subtree, byteseq):
-            for i, byte in enumerate(byteseq):
-                byte = f"{byte:02X}"
-                if 'value' in subtree:
-                    matches.append(subtree['value'])
-                if '??' in subtree:
-                    _match(subtree['??'], byteseq[i+1:])
-                if byte in subtree:
-                    subtree = subtree[byte]
-                else:
+    def __signatures(self):
+        """ Parse the databases in their order, yielding (database, signature fields) tuples, the signatures already
+             defined (same kind and bytes) by a previous database being skipped. """
+        if len(self.paths) == 1:
+            for fields in parse(self.path, self.encoding, logger=self.logger):
+                yield self.path, fields[:5]
+            return
+        seen = set()
+        for path in self.paths:
+            keys = set()
+            for fields in parse(path, self.encoding, logger=self.logger):
+                if (key := (fields[3], fields[4], tuple(fields[1]))) not in seen:
+                    keys.add(key)
+                    yield path, fields[:5]
+            seen |= keys
+    
+    def __load(self, path, encoding="utf-8", cache=True, compaction=False):
+        """ Load the signatures database into a compiled index and cache it with an atomic write, the journal of the
+             previous index being removed. When compacting, the index is discarded if the database was edited while
+             it was being built. """
+        from tempfile import mkstemp
+        def _signatures():
+            for origin, (name, signature, trailing_wildcards, ep_only, sec_start_only) in self.__signatures():
+                if self.keep_trailing_wildcards:
+                    signature += trailing_wildcards.strip().split()
+                yield 'ep_only' if ep_only else 'section_start_only' if sec_start_only else '', signature, name, origin
+        # fingerprint the database before parsing it so that a concurrent edit makes the cache outdated
+        source = _fingerprint(path, True)
+        data = Index.build(_signatures(), source)
+        with self.__lock:
+            if compaction and _fingerprint(path)[:2] != source[:2]:
+                if self.logger:
+                    self.logger.debug(f"Compaction of the index of {path} discarded as the database was edited")
+                return
+            self.__index = Index(data)
+            if not cache:
+                return
+            for p in self.cache_paths:
+                tmp = None
+                try:
+                    os.makedirs(dirname(p), exist_ok=True)
+                    fd, tmp = mkstemp(prefix=basename(p) + ".", suffix=".tmp", dir=dirname(p))
+                    with os.fdopen(fd, 'wb') as f:
+                        f.write(data)
+                    os.chmod(tmp, 0o644)
+                    os.replace(tmp, p)
+                    Journal(p).remove()
+                    self.cache_path = p
                     break
-        with open_exe(pe, logger=self.logger) as f:
-            if ep_only:
-                for byteseq in f.read(n_bytes, f.entrypoint_offset):
-                    _match(self.__tree['ep_only'], byteseq)
-                if not match_all and len(matches) > 0:
-                    return matches[-1]
-            elif sec_start_only:
-                for byteseq in f.read(n_bytes, *f.sections_offsets):
-                    _match(self.__tree['section_start_only'], byteseq)
-                    if not match_all and len(matches) > 0:
-                        return matches[-1]
+                except OSError as e:
+                    if tmp is not None and os.path.exists(tmp):
+                        os.remove(tmp)
+                    if self.logger:
+                        self.logger.debug(f"Could not cache the compiled index to {p}: {e}")
+    
+    @property
+    def max_depth(self):
+        """ Length of the longest signature, that is, the number of bytes to be read for matching a window. """
+        return self.__index.max_depth
+    
+    def __hits(self, f, index, kinds, first=False, cache=None):
+        """ Match an opened executable against the subtrees of the given kinds of an index, yielding (offset, kind,
+             signature index) for every hit (see hits). """
+        from itertools import islice
+        def _walk(kind, offsets, windows):
+            if kind == "":
+                for offset, idx in self.__scan(f, index, first=first):
+                    yield offset, kind, idx
+                return
+            for offset, window in zip(offsets, windows):
+                if first:
+                    if (idx := index.first(kind, window)) is not None:
+                        yield offset, kind, idx
+                        return
+                    continue
+                for idx in index.match(kind, window, []):
+                    yield offset, kind, idx
+        # the windows of all the kinds are read at once so that close ones (e.g. section starts) get coalesced in a
+        #  single read
+        offsets = {}
+        for kind in [k for k in kinds if k != ""]:
+            try:
+                offsets[kind] = [f.entrypoint_offset] if kind == "ep_only" else f.sections_offsets
+            except MalformedPE as e:
+                # an entry point outside the sections (common with packers) only prevents matching its own kind
+                if len(kinds) == 1:
+                    raise
+                if self.logger:
+                    self.logger.warning(f"{f.path}: {e} ; {kind} signatures skipped")
+        flat = [o for k in offsets for o in offsets[k]]
+        windows = iter(list(f.read(index.max_depth, *flat)) if len(flat) > 0 else [])
+        for kind in kinds:
+            if kind != "" and kind not in offsets:
+                continue
+            o = offsets.get(kind, [])
+            w = list(islice(windows, len(o)))
+            if cache is None:
+                yield from _walk(kind, o, w)
+                continue
+            from hashlib import sha256
+            # the results depend on the database, the numbering of its signatures in the index (as hits hold their
+            #  indices), the matching mode and the matched bytes of the sample only
+            h = sha256(f"{INDEX_VERSION}|{self.keep_trailing_wildcards}|{kind}|{first}|".encode())
+            h.update(index.source[2] + index.layout)
+            if kind == "":
+                for chunk in f.chunks():
+                    h.update(chunk)
             else:
-                for byteseq in f.read(n_bytes):
-                    _match(self.__tree[''], byteseq)
-                    if not match_all and len(matches) > 0:
-                        return matches[-1]
-            if len(matches) > 0:
-                return matches
+                h.update(repr(o).encode())
+                for window in w:
+                    h.update(window)
+            if (hits := cache.lookup(key := h.digest())) is None:
+                cache.store(key, hits := list(_walk(kind, o, w)))
+            yield from hits
+    
+    def __scan(self, f, index, chunk_size=CHUNK_SIZE, first=False):
+        """ Scan an opened executable with the signatures of an index, yielding (offset, signature index) for every hit
+             (see scan). With first, only the hit with the highest priority (see Index.first) at the lowest offset is
+             yielded, ties being resolved in favor of the first signature of the index. """
+        n = index.max_depth
+        # the automaton is rebuilt when the index gets replaced (see update and compact)
+        if self.__automaton is None or self.__automaton[0] is not index:
+            # the indices of the signatures are used as names so that the name variant is resolved at the end
+            self.__automaton = (index, Automaton(index.signatures('')))
+        auto, mapped = self.__automaton[1], f.buffer is not None
+        def _hits():
+            state, pos, base, buf, pending = 0, 0, 0, f.buffer or b"", set()
+            for chunk in f.chunks(chunk_size):
+                state, candidates = auto.candidates(chunk, pos, state)
+                pending |= candidates
+                buf, pos = buf if mapped else buf + chunk, pos + len(chunk)
+                # candidates found later cannot start before pos - n, hence offsets up to there can be confirmed (all
+                #  the candidates at a given offset thus get confirmed at once, by increasing index)
+                for o, idx in sorted(c for c in pending if c[0] <= pos - n):
+                    pending.discard((o, idx))
+                    if auto.verify(buf, o - base, idx):
+                        yield o, idx
+                if not mapped and pos - n > base:
+                    buf, base = buf[pos-n-base:], pos - n
+            for o, idx in sorted(pending):
+                if auto.verify(buf, o - base, idx):
+                    yield o, idx
+        if not first:
+            for o, idx in _hits():
+                yield o, auto.names[idx]
+            return
+        best = None
+        for o, idx in _hits():
+            if best is not None and o > best[0]:
+                break
+            if best is None or auto.priorities[idx] > auto.priorities[best[1]]:
+                best = (o, idx)
+        if best is not None:
+            yield best[0], auto.names[best[1]]
+    
+    def hits(self, pe, ep_only=True, sec_start_only=False, normalize=False, first=False, cache=None, all_kinds=False,
+             source=False, use_mmap=False):
+        """ Match an executable, yielding (offset, kind, name) for every hit ; offset is the entry point, the section
+             start or the position of the hit in the file, and kind is "ep_only", "section_start_only" or "" for the
+             signatures matched anywhere in the file. Names are normalized as precomputed in the index (see
+             _variant). With first, only the hit with the highest priority of the first matching window is yielded
+             (see Index.first). With cache (see ResultsCache), the hits are looked up with the digest of the bytes
+             to be matched before walking the signatures. With all_kinds, ep_only and sec_start_only are ignored and
+             the three kinds of signatures are matched in this order with a single opening of the executable, the
+             windows at the entry point and at the section starts being read at once (first then applies per kind).
+             With source, the path to the database each signature comes from is appended to the tuples. With use_mmap,
+             the executable is memory-mapped instead of being read through buffered reads. """
+        if ep_only and sec_start_only and not all_kinds:
+            raise ValueError("ep_only and section_start_only are mutually exclusive")
+        variant, index = _variant(normalize), self.__index
+        kinds = KINDS if all_kinds else ["ep_only" if ep_only else "section_start_only" if sec_start_only else ""]
+        with open_exe(pe, logger=self.logger, use_mmap=use_mmap) as f:
+            for offset, kind, idx in self.__hits(f, index, kinds, first, cache):
+                yield (offset, kind, index.name(idx, variant)) + ((index.origin(idx), ) if source else ())
+    
+    def match(self, pe, ep_only=True, sec_start_only=False, match_all=True, details=False, normalize=False,
+              cache=None, all_kinds=False, source=False, use_mmap=False):
+        """ Match a given bytes sequence against the search tree ; with details, (offset, kind, name) tuples (see hits)
+             are returned instead of names, with source, the database of each signature being appended to them.
+        
+        When match_all is False, the search stops at the first matching window (the entry point, then the section starts
+         in their order, or the first hit anywhere in the file) and returns its signature with the highest priority,
+         that is, the longest one, then the one with the most literal bytes (see Index.first). With all_kinds, all the
+         kinds of signatures are matched at once (see hits) and a list is always returned, holding the signature with
+         the highest priority of each kind when match_all is False.
+        """
+        matches = []
+        for hit in self.hits(pe, ep_only, sec_start_only, normalize, not match_all, cache, all_kinds, source,
+                             use_mmap):
+            hit = hit if details else hit[2]
+            if not match_all and not all_kinds:
+                return hit
+            matches.append(hit)
+        return matches or None
+    
+    def match_bytes(self, data, kind="ep_only", normalize=False):
+        """ Match a bytes sequence against the subtree of the given kind ("ep_only", "section_start_only" or ""),
+             returning the names of the matching signatures. """
+        variant, index = _variant(normalize), self.__index
+        return [index.name(idx, variant) for idx in index.match(kind, data, [])]
+    
+    def scan(self, pe, chunk_size=CHUNK_SIZE, ids=False, use_mmap=False):
+        """ Scan the whole executable in a single pass, yielding (offset, name) for every hit of the signatures that are
+             neither ep_only nor section_start_only, by increasing offset (with ids, the index of the signature is
+             yielded instead of its name). With use_mmap, the executable is memory-mapped and the candidates are
+             confirmed on the mapping, otherwise on a buffer holding the last bytes read. """
+        index = self.__index
+        with open_exe(pe, logger=self.logger, use_mmap=use_mmap) as f:
+            for offset, idx in self.__scan(f, index, chunk_size):
+                yield offset, idx if ids else index.name(idx)
+    
+    def update(self, added=(), removed=()):
+        """ Apply edits of the database to its compiled index without rebuilding it, once the database itself has been
+             edited (see SignaturesDB.dump).
+        
+        The removed and renamed signatures are masked in the index while the added ones are compiled into a small index
+         matched along with it (see JournaledIndex). The edits are appended to the journal of the cached index so that
+         the next loads of the database apply them too, the index being rebuilt in the background (see compact) once
+         the journal holds COMPACTION signatures.
+        
+        :param added:   (kind, bytes, name) tuples of the added or renamed signatures, kind being "ep_only",
+                         "section_start_only" or "" and bytes a list of hexadecimal tokens (or a string)
+        :param removed: (kind, bytes) tuples of the removed signatures
+        """
+        if len(self.paths) > 1:
+            raise ValueError("A layered index cannot be updated")
+        def _key(kind, signature):
+            if kind not in KINDS:
+                raise ValueError(f"Bad kind of signature '{kind}'")
+            signature = signature.split() if isinstance(signature, str) else list(signature)
+            n = len(signature)
+            while not self.keep_trailing_wildcards and n > 1 and signature[n-1] == "??":
+                n -= 1
+            return kind, tuple(signature[:n])
+        edits = {_key(kind, signature): None for kind, signature in removed}
+        edits.update({_key(kind, signature): name for kind, signature, name in added})
+        with self.__lock:
+            index, source = self.__index, _fingerprint(self.path, True)
+            base = index.base if isinstance(index, JournaledIndex) else index
+            if self.cache_path is not None:
+                try:
+                    Journal(self.cache_path).append(base, edits, source)
+                except OSError as e:
+                    if self.logger:
+                        self.logger.debug(f"Could not journal the edits of {self.path}: {e}")
+            if isinstance(index, JournaledIndex):
+                edits = {**index.edits, **edits}
+            self.__index = JournaledIndex(base, edits, source, self.path)
+        if len(edits) >= COMPACTION:
+            self.compact()
+    
+    def compact(self, wait=False):
+        """ Rebuild the compiled index from the database in a background thread, replacing the index brought up to date
+             with its journal (see update) ; matching goes on with the current index meanwhile. The thread is not a
+             daemon, hence the rebuild completes before the interpreter exits. If a rebuild is already running, no
+             other one is started.
+        
+        :param wait: whether to wait for the rebuild to complete
+        :return:     the thread rebuilding the index
+        """
+        from threading import Thread
+        with self.__lock:
+            if self.__compaction is None or not self.__compaction.is_alive():
+                self.__compaction = Thread(target=self.__load, args=(self.path, self.encoding,
+                                                                     self.cache_path is not None, True))
+                self.__compaction.start()
+            t = self.__compaction
+        if wait:
+            t.join()
+        return t
 
 
 class SignaturesDB(SignaturesTree):
-    """ Heavier class for providing more DB-related operations like comparing with another DB, adding new rules, ... """
-    def __init__(self, path=None, encoding="utf-8", cache=True):
-        super(SignaturesDB, self).__init__(path, encoding, cache)
-        self.signatures = {}
-        # use the signature bytes as the key
-        for fields in self:
-            self.signatures[tuple(fields[1])] = fields
-        # catch comments
+    """ Heavier class for providing more DB-related operations like comparing with another DB, adding new rules, ...
+    
+    Signatures are indexed by name and by length so that filtering and removing them do not require to scan the whole
+     database ; self.signatures is therefore to be modified through set, set_many, unset and unset_many only. The edits
+     are recorded so that dumping the database to its own path applies them to its compiled index (see update) instead
+     of letting the next load rebuild it.
+    """
+    def __init__(self, path=None, encoding="utf-8", cache=True, logger=None):
+        if not isinstance(_paths(path), str):
+            raise ValueError("A signatures database cannot be layered")
+        super(SignaturesDB, self).__init__(path, encoding, cache, logger=logger)
+        self.signatures, self.__names, self.__sizes, self.__edits = {}, {}, {}, None
+        signatures, comments, self.__duplicates = _load(self.path, self.encoding, self.logger)
+        for sig, fields in signatures.items():
+            self.__add(sig, fields)
+        # signatures sharing their bytes get merged when loaded, hence the dump would not match the index with the edits
+        self.__edits = {} if len(self.__duplicates) == 0 else None
         self.comments = []
-        with open(self.path, encoding=self.encoding) as f:
-            for l in f:
-                if not l.startswith(";"):
-                    break
-                self.comments.extend(list(map(lambda x: x.lstrip("; ").rstrip(". \n"), l.lstrip("; ").split(";"))))
+        for l in comments:
+            self.comments.extend(list(map(lambda x: x.lstrip("; ").rstrip(". \n"), l.lstrip("; ").split(";"))))
     
     def __eq__(self, db):
-        return set(self.signatures) == set(self.__get(db).signatures)
+        return set(self.signatures) == set(self.__get(db))
     
     def __len__(self):
         return len(self.signatures)
     
+    def __add(self, sig, fields):
+        """ Add a signature (keyed by its bytes) to self.signatures and to the name and length indexes. """
+        if sig in self.signatures:
+            self.__remove(sig)
+        self.signatures[sig] = fields
+        if self.__edits is not None:
+            self.__edits[self.__key(fields)] = fields[0]
+        self.__names.setdefault(fields[0], {})[sig] = None
+        self.__sizes.setdefault(len(fields[1]), {})[sig] = None
+    
     def __get(self, db, encoding=None):
-        if not isinstance(db, SignaturesDB):
-            db = SignaturesDB(db, encoding or self.encoding)
-        return db
+        """ Get the signatures of a database ; when given as a path, it is only parsed, its index is not compiled. """
+        if isinstance(db, SignaturesDB):
+            return db.signatures
+        return _load(db, encoding or self.encoding, self.logger)[0]
+    
+    @staticmethod
+    def __key(fields):
+        """ Identify a signature in the compiled index by its kind and its bytes. """
+        return SignaturesDB.__kind(fields), tuple(fields[1]) + tuple(fields[2].split())
+    
+    @staticmethod
+    def __kind(fields):
+        return 'ep_only' if fields[3] else 'section_start_only' if fields[4] else ''
+    
+    def __remove(self, sig):
+        """ Remove a signature (keyed by its bytes) from self.signatures and from the name and length indexes. """
+        fields = self.signatures.pop(sig)
+        name, signature = fields[:2]
+        if self.__edits is not None:
+            self.__edits[self.__key(fields)] = None
+        for index, key in [(self.__names, name), (self.__sizes, len(signature))]:
+            del index[key][sig]
+            if len(index[key]) == 0:
+                del index[key]
+    
+    def __set(self, name, signature, ep_only=True, sec_start_only=False, author=None, version=None):
+        if ep_only and sec_start_only:
+            raise ValueError("ep_only and section_start_only are mutually exclusive")
+        if version:
+            name += " %s" % version
+        if author:
+            name += " -> %s" % author
+        if isinstance(signature, str):
+            signature = signature.split()
+        self.__add(tuple(signature), (name, signature, "", ep_only, sec_start_only))
     
     def __signature(self, name, signature, ep_only, sec_start_only, size):
         """ Output a signature as a string. """
@@ -149,44 +529,59 @@ class SignaturesDB(SignaturesTree):
         :param encoding: encoding for dumping the database
         :return:         generator producing signatures not present in this database but well in the compared one
         """
-        for sig, fields in self.__get(db, encoding).signatures.items():
+        for sig, fields in self.__get(db, encoding).items():
             if sig not in self.signatures:
                 yield fields[0]
     
     def dump(self, filename=None, encoding=None):
-        """ Dump self.signatures to the given path.
+        """ Dump self.signatures to the given path ; when dumped to its own path, the edits of the database since it was
+             loaded or last dumped are applied to its compiled index (see update).
         
         :param filename: path to database dump
         :param encoding: encoding for dumping the database
         """
-        with open(filename or self.path, 'wt', encoding=encoding or self.encoding) as f:
+        path = os.path.abspath(expanduser(filename or self.path))
+        with open(path, 'wt', encoding=encoding or self.encoding) as f:
             for l in self.comments:
                 f.write("; %s\n" % l)
             f.write("\n")
             for sig, fields in sorted(self.signatures.items(), key=lambda x: x[1][0]):
-                name, signature, _, ep_only, sec_start_only = fields
+                name, signature, trailing_wildcards, ep_only, sec_start_only = fields
                 cond = ["", "section_start_only = %s\n" % str(sec_start_only).lower()][sec_start_only]
-                f.write(f"[{name}]\nsignature = {signature}\nep_only = {str(ep_only).lower()}\n{cond}\n")
+                f.write(f"[{name}]\nsignature = {' '.join(signature)}{trailing_wildcards}\n"
+                        f"ep_only = {str(ep_only).lower()}\n{cond}\n")
+        if path == self.path and self.__edits:
+            self.update([(k, s, n) for (k, s), n in self.__edits.items() if n is not None],
+                        [(k, s) for (k, s), n in self.__edits.items() if n is None])
+            self.__edits.clear()
     
     def filter(self, pattern, text=True, size=None, remove=False):
-        """ Filter signatures based on a given name pattern and/or a signature size. """
-        regex, rem = re.compile(pattern or r".*"), []
+        """ Filter signatures based on a given name pattern and/or a signature size ; the pattern is searched once per
+             distinct name and the size expression evaluated once per distinct length (see the indexes). """
+        selected = None
+        if pattern:
+            regex = re.compile(pattern)
+            selected = {sig for name, sigs in self.__names.items() if regex.search(name) for sig in sigs}
+        if size is not None:
+            sized = {sig for length, sigs in self.__sizes.items() if size(length) for sig in sigs}
+            selected = sized if selected is None else selected & sized
+        # signatures are yielded in the order of the database
+        rem = []
         for sig, data in self.signatures.items():
-            name, signature, trailing_wildcards, ep_only, sec_start_only = data
-            if regex.search(name):
+            if selected is None or sig in selected:
+                name, signature, trailing_wildcards, ep_only, sec_start_only = data
                 r = (name, f"{' '.join(signature)} {trailing_wildcards}", ep_only, sec_start_only,
-                     (s := len(signature)) if size else None)
-                if size is None or size(s):
-                    yield self.__signature(*r) if text else r
-                    if remove:
-                        rem.append(sig)
-        for sig in rem:
-            self.unset(signature=sig)
+                     len(signature) if size else None)
+                yield self.__signature(*r) if text else r
+                if remove:
+                    rem.append(sig)
+        if len(rem) > 0:
+            self.unset_many(signatures=rem)
     
     def merge(self, *dbs):
         """ Merge multiple signatures databases.
         
-        :param dbs: paths to databases
+        :param dbs: paths to databases (only parsed, their indices are not compiled) or SignaturesDB instances
         :post:      signatures from given databases added to self.signatures and self.comments updated
         """
         from datetime import date
@@ -194,15 +589,83 @@ class SignaturesDB(SignaturesTree):
         if len(self) > 0:
             self.comments.append(" - " + basename(self.path))
         for db in dbs:
-            db, added = self.__get(db), False
-            for sig, fields in db.signatures.items():
+            added = False
+            for sig, fields in self.__get(db).items():
                 if sig not in self.signatures:
-                    self.signatures[sig] = fields
+                    self.__add(sig, fields)
                     added = True
             if added:
-                self.comments.append(" - " + basename(db.path))
+                self.comments.append(" - " + basename(db.path if isinstance(db, SignaturesDB) else db))
         self.comments.append(f"{len(self)} signatures in list")
     
+    def minimize(self, max_wildcards=.5, remove=()):
+        """ Find the signatures that are redundant or that make the database ambiguous or slow to match, yielding
+             (reason, name, signature, kind, other name, nodes, wildcard nodes) tuples, reason being one of :
+             - "duplicate":  same bytes as a next signature of the database (the other one), which overrode it when
+                              loaded
+             - "subsumed":   every window it matches is also matched by a more general signature with the same name,
+                              which is kept
+                              (e.g. a prefix of it, or having "??" instead of some of its bytes) ; removing it leaves
+                              the names matched unchanged, but the signature with the highest priority of a window (see
+                              Index.first) may then be one with another name
+             - "shadowed":   idem with a signature with another name, both names being reported for such windows
+             - "degenerate": holding malformed bytes, which can never match, or more than max_wildcards "??" tokens
+                              (trailing ones included)
+            nodes is the number of nodes of the search tree used by this signature only, wildcard nodes the number of
+             these nodes reached through "??", each of them being an extra branch to walk while matching ; both are
+             saved when the signature is removed. Signatures are compared as compiled, without their trailing "??".
+        
+        :param max_wildcards: maximum proportion of "??" tokens in a signature
+        :param remove:        reasons for which the signatures are to be removed (e.g. ["subsumed", "degenerate"]), the
+                               duplicates being already merged
+        """
+        from .index import BYTES
+        keys, rem = list(self.signatures), []
+        # search tree of the signatures, counting the signatures that use each node
+        children, counts, paths = {}, [0] * len(KINDS), {}
+        for sig in keys:
+            fields, path = self.signatures[sig], []
+            node = KINDS.index(self.__kind(fields))
+            for token in fields[1]:
+                if (node, token) not in children:
+                    children[(node, token)] = len(counts)
+                    counts.append(0)
+                node = children[(node, token)]
+                counts[node] += 1
+                path.append((node, token == "??"))
+            paths[sig] = path
+        def _result(reason, fields, other=None):
+            # duplicates were merged when loaded, hence they use no node of their own
+            own = [] if reason == "duplicate" else [w for node, w in paths[tuple(fields[1])] if counts[node] == 1]
+            return reason, fields[0], " ".join(fields[1]) + fields[2], self.__kind(fields), other, len(own), sum(own)
+        for fields in self.__duplicates:
+            if (other := self.signatures.get(tuple(fields[1]))) is not None:
+                yield _result("duplicate", fields, other[0])
+        valid = [sig for sig in keys if all(t == "??" or t in BYTES for t in self.signatures[sig][1])]
+        for sig in keys:
+            fields = self.signatures[sig]
+            tokens = fields[1] + fields[2].split()
+            if any(t != "??" and t not in BYTES for t in tokens) or tokens.count("??") > max_wildcards * len(tokens):
+                yield _result("degenerate", fields)
+                if "degenerate" in remove:
+                    rem.append(sig)
+        # the more general signatures are searched in an index of the valid signatures that are kept, so that a
+        #  signature is never removed for being subsumed by a removed one ; names are not needed in this index
+        removed = set(rem)
+        kept = [sig for sig in valid if sig not in removed]
+        index = Index(Index.build((self.__kind(self.signatures[sig]), self.signatures[sig][1], "") for sig in kept))
+        for sig in valid:
+            fields = self.signatures[sig]
+            others = [self.signatures[kept[j]][0] for j in index.generalizations(self.__kind(fields), fields[1])
+                      if kept[j] != sig]
+            if len(others) > 0:
+                reason = "subsumed" if fields[0] in others else "shadowed"
+                yield _result(reason, fields, fields[0] if reason == "subsumed" else others[0])
+                if reason in remove and sig not in rem:
+                    rem.append(sig)
+        if len(rem) > 0:
+            self.unset_many(signatures=rem)
+    
     def set(self, name, signature, ep_only=True, sec_start_only=False, author=None, version=None):
         """ Add/update a signature based on the given data.
         
@@ -214,24 +677,35 @@ class SignaturesDB(SignaturesTree):
         :param version:        version of the name matched by the signature
         :post:                 new signature added to self.signatures
         """
-        if ep_only and sec_start_only:
-            raise ValueError("ep_only and section_start_only are mutually exclusive")
-        if version:
-            name += " %s" % version
-        if author:
-            name += " -> %s" % author
-        self.signatures[tuple(signature)] = (name, signature, "", ep_only, False)
+        self.__set(name, signature, ep_only, sec_start_only, author, version)
+        self.__update_nsig()
+    
+    def set_many(self, signatures):
+        """ Add/update multiple signatures at once.
+        
+        :param signatures: iterable of tuples of arguments or dictionaries of keyword-arguments of set
+        :post:             new signatures added to self.signatures
+        """
+        for s in signatures:
+            self.__set(**s) if isinstance(s, dict) else self.__set(*s)
         self.__update_nsig()
     
     def unset(self, name=None, signature=None):
-        """ Remove a single signature based on its name or bytes. """
+        """ Remove a single signature based on its bytes or all the signatures with the given name. """
         if name or signature:
-            if signature:
-                del self.signatures[tuple(signature)]
-            else:
-                for sig in [d[1] for s, d in self.signatures.items() if name == d[0]]:
-                    del self.signatures[sig]
-            self.__update_nsig()
+            self.unset_many([name] if name and not signature else (), [signature] if signature else ())
             return
         raise ValueError(f"no name or signature provided")
-
+    
+    def unset_many(self, names=(), signatures=()):
+        """ Remove multiple signatures at once based on their names and/or bytes (strings or lists of bytes) ; unknown
+             names are ignored while unknown signatures raise a KeyError. """
+        for sig in signatures:
+            sig = tuple(sig.split() if isinstance(sig, str) else sig)
+            if sig not in self.signatures:
+                raise KeyError(sig)
+            self.__remove(sig)
+        for name in names:
+            for sig in list(self.__names.get(name, ())):
+                self.__remove(sig)
+        self.__update_nsig()
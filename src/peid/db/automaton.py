@@ -0,0 +1,86 @@
+# -*- coding: UTF-8 -*-
+import re
+from collections import deque
+
+
+__all__ = ["Automaton"]
+
+
+ANCHOR_MAX = 8
+
+
+class Automaton:
+    """ Aho-Corasick automaton built on the longest literal run (the anchor) of each signature.
+    
+    The scanned bytes are consumed once ; each anchor hit yields a candidate (start offset, signature index) that is
+     then confirmed by matching the compiled pattern of the signature at this offset. The priority of each signature
+     (length, number of literal bytes) is kept for choosing between the hits at a same offset (see Index.first).
+    """
+    def __init__(self, signatures):
+        goto, outputs, self.names, self.patterns, self.priorities, self.unanchored = [{}], [set()], [], [], [], []
+        for idx, (signature, name) in enumerate(signatures):
+            self.names.append(name)
+            self.priorities.append((len(signature), sum(b is not None for b in signature)))
+            self.patterns.append(re.compile(b"".join(b"." if b is None else re.escape(bytes([b])) for b in signature),
+                                            re.S))
+            anchor, back = self.anchor(signature)
+            if len(anchor) == 0:
+                self.unanchored.append(idx)
+                continue
+            s = 0
+            for byte in anchor:
+                if byte not in goto[s]:
+                    goto[s][byte] = len(goto)
+                    goto.append({})
+                    outputs.append(set())
+                s = goto[s][byte]
+            outputs[s].add((back, idx))
+        # compute failure links in breadth-first order and derive the dense transition table (DFA)
+        self.delta, fail = [None] * len(goto), [0] * len(goto)
+        self.delta[0] = [goto[0].get(b, 0) for b in range(256)]
+        queue = deque(goto[0].values())
+        while queue:
+            s = queue.popleft()
+            f = fail[s]
+            outputs[s] |= outputs[f]
+            row = self.delta[f][:]
+            for byte, t in goto[s].items():
+                fail[t] = self.delta[f][byte]
+                row[byte] = t
+                queue.append(t)
+            self.delta[s] = row
+        self.outputs = [tuple(sorted(o)) for o in outputs]
+    
+    def __len__(self):
+        return len(self.delta)
+    
+    @staticmethod
+    def anchor(signature):
+        """ Get the longest run of literal bytes of the given signature (list of bytes with None as wildcard), truncated
+             to ANCHOR_MAX bytes, together with the index of its last byte in the signature. """
+        best, start = (0, 0), None
+        for i, byte in enumerate(list(signature) + [None]):
+            if byte is None:
+                if start is not None and i - start > best[1] - best[0]:
+                    best = (start, i)
+                start = None
+            elif start is None:
+                start = i
+        i, j = best[0], min(best[1], best[0] + ANCHOR_MAX)
+        return bytes(signature[i:j]), j - 1
+    
+    def candidates(self, chunk, offset=0, state=0):
+        """ Consume a chunk of bytes located at the given offset from the given state and return the new state with the
+             set of candidates (start offset, signature index). """
+        delta, outputs, starts = self.delta, self.outputs, set()
+        for i, byte in enumerate(chunk, offset):
+            state = delta[state][byte]
+            if outputs[state]:
+                starts.update((i - b, idx) for b, idx in outputs[state] if i >= b)
+        for idx in self.unanchored:
+            starts.update((i, idx) for i in range(offset, offset + len(chunk)))
+        return state, starts
+    
+    def verify(self, buffer, position, idx):
+        """ Check if the signature with the given index matches the buffer at the given position. """
+        return self.patterns[idx].match(buffer, position) is not None
@@ -0,0 +1,83 @@
+# -*- coding: UTF-8 -*-
+import os
+import sqlite3
+from os.path import abspath, dirname, expanduser, join
+from threading import Lock
+from time import time_ns
+
+
+__all__ = ["ResultsCache"]
+
+
+_CACHES, _CACHES_LOCK = {}, Lock()
+
+
+class ResultsCache:
+    """ On-disk cache of matching results, stored in a SQLite database and keyed by the digest of what determines them
+         (the database, the matching mode and the bytes of the sample that are matched), so that resubmitted samples
+         are answered without walking the signatures.
+    
+    The least recently used results are evicted when the cache holds more than max_entries results. Hits and misses are
+     counted per instance (see stats).
+    """
+    def __init__(self, path=None, max_entries=1 << 20):
+        from . import CACHE_DIR
+        self.path = abspath(expanduser(path or join(CACHE_DIR, "results.sqlite")))
+        self.max_entries, self.hits, self.misses = max_entries, 0, 0
+        os.makedirs(dirname(self.path), exist_ok=True)
+        self.__lock = Lock()
+        self.__db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute("PRAGMA synchronous=NORMAL")
+        self.__db.execute("CREATE TABLE IF NOT EXISTS results (key BLOB PRIMARY KEY, hits BLOB, used INTEGER)")
+        self.__db.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+        self.__count = self.__db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+    
+    def __len__(self):
+        return self.__db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+    
+    @classmethod
+    def get(cls, path=None, max_entries=1 << 20):
+        """ Get the instance shared within the process for the given path (thread-safe). """
+        key = abspath(expanduser(path)) if path else None
+        with _CACHES_LOCK:
+            if key not in _CACHES:
+                _CACHES[key] = cls(path, max_entries)
+            return _CACHES[key]
+    
+    @property
+    def stats(self):
+        """ Counters of this instance, with the number of results in the cache. """
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self)}
+    
+    def clear(self):
+        with self.__lock:
+            self.__db.execute("DELETE FROM results")
+            self.__count = 0
+    
+    def close(self):
+        self.__db.close()
+    
+    def lookup(self, key):
+        """ Get the hits (list of (offset, kind, signature index) tuples) cached for the given key, or None. """
+        from msgspec.json import decode
+        with self.__lock:
+            row = self.__db.execute("SELECT hits FROM results WHERE key = ?", (key, )).fetchone()
+            if row is None:
+                self.misses += 1
+                return
+            self.hits += 1
+            self.__db.execute("UPDATE results SET used = ? WHERE key = ?", (time_ns(), key))
+        return [tuple(hit) for hit in decode(row[0])]
+    
+    def store(self, key, hits):
+        """ Cache the hits for the given key, evicting the least recently used results if the cache is full. """
+        from msgspec.json import encode
+        with self.__lock:
+            self.__db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?)", (key, encode(hits), time_ns()))
+            self.__count += 1
+            # the count is tracked approximately (other processes may share the cache) and fixed when evicting
+            if self.__count > self.max_entries:
+                self.__db.execute("DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY used LIMIT "
+                                  "MAX(0, (SELECT COUNT(*) FROM results) - ?))", (self.max_entries * 9 // 10, ))
+                self.__count = self.__db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
@@ -0,0 +1,272 @@
+# -*- coding: UTF-8 -*-
+import struct
+from array import array
+
+from .parser import normalize
+
+
+__all__ = ["Index"]
+
+
+BYTE = [bytes([b]) for b in range(256)]
+BYTES = {f"{b:02X}": b for b in range(256)}
+HEADER = struct.Struct("=8s6I2Q32s")
+KINDS = ("ep_only", "section_start_only", "")
+MAGIC, VERSION = b"PEIDIDX\0", 6
+# name variants stored for each signature: raw, without author, without version, without both
+VARIANTS = ((False, False), (True, False), (False, True), (True, True))
+
+
+class Index:
+    """ Compiled signatures index, stored as flat arrays that can be memory-mapped and queried without decoding.
+    
+    Layout (after the header, each array being 4-bytes aligned):
+     - edges:   first edge index of each node (n_nodes + 1 items, uint32), edges of a node being contiguous
+     - wild:    child node through "??" of each node (n_nodes items, uint32, 0 if none)
+     - term:    index + 1 of the signature ending at each node (n_nodes items, uint32, 0 if none)
+     - height:  length of the longest path below each node (n_nodes items, uint32), for pruning the search of the
+                 first match
+     - jump:    for a node only followed by "??" (no edge, no signature ending there), the first node of its chain of
+                 wildcards that is not (n_nodes items, uint32, 0 if none), for skipping runs of wildcards at once
+     - hops:    length of the chain of wildcards skipped by jump (n_nodes items, uint32)
+     - labels:  byte value of each edge (n_edges bytes)
+     - targets: child node of each edge (n_edges items, uint32)
+     - names:   string of each name variant (see VARIANTS) of each signature (n_names * 4 items, uint32)
+     - origins: string of the database each signature comes from (n_names items, uint32)
+     - strings: offsets of the distinct names in the blob (n_strings + 1 items, uint32)
+     - blob:    UTF-8-encoded distinct names
+    
+    Node 0 is a sentinel ; the roots of the ep_only, section_start_only and full-file subtrees are nodes 1, 2 and 3.
+    The header also holds the fingerprint (size, modification time in ns, SHA256 digest) of the source database(s).
+    """
+    # the signatures are numbered in the order of the source database(s), hence their digest identifies the numbering
+    layout = b""
+    
+    def __init__(self, buffer):
+        magic, version, self.max_depth, n_nodes, n_edges, n_names, n_strings, *self.source = \
+            HEADER.unpack_from(buffer)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a compatible signatures index")
+        self._buffer, self._cache, mv, o = buffer, {}, memoryview(buffer), HEADER.size
+        def _array(n, itemsize=4):
+            nonlocal o
+            start, o = o, o + (n * itemsize + 3) // 4 * 4
+            return mv[start:start+n*itemsize].cast("I") if itemsize == 4 else start
+        self._edges, self._wild, self._term = _array(n_nodes + 1), _array(n_nodes), _array(n_nodes)
+        self._height, self._jump, self._hops = _array(n_nodes), _array(n_nodes), _array(n_nodes)
+        # labels are kept as an offset in the buffer in order to search for bytes with buffer.find
+        self._labels = _array(n_edges, 1)
+        self._targets, self._names, self._origins = _array(n_edges), _array(n_names * 4), _array(n_names)
+        self._strings = _array(n_strings + 1)
+        self._blob = o
+    
+    def __len__(self):
+        return len(self._names) // 4
+    
+    @staticmethod
+    def build(signatures, source=(0, 0, b"")):
+        """ Compile (kind, bytes, name[, origin]) tuples into an index ; kind is one of KINDS and bytes is a list of
+             hexadecimal tokens including "??" for wildcards, origin being the database the signature comes from.
+             Signatures with malformed bytes (e.g. "0?") are discarded as they can never match. source is the
+             fingerprint of the database(s) the signatures come from. The normalized variants of the names are
+             computed once here, so that they cost nothing at matching time. """
+        trie, names, origins, max_depth = [{}, {}, {}, {}], [], [], 0
+        terms = {}
+        for kind, signature, name, *origin in signatures:
+            node = KINDS.index(kind) + 1
+            try:
+                signature = [None if b == "??" else BYTES[b] for b in signature]
+            except KeyError:
+                continue
+            max_depth = max(max_depth, len(signature))
+            for byte in signature:
+                if byte not in trie[node]:
+                    trie[node][byte] = len(trie)
+                    trie.append({})
+                node = trie[node][byte]
+            terms[node] = len(names)
+            names.append(name)
+            origins.append(origin[0] if origin else "")
+        # renumber nodes in breadth-first order so that the edges of each node are contiguous and sorted
+        order, new, i = [0, 1, 2, 3], {0: 0, 1: 1, 2: 2, 3: 3}, 1
+        while i < len(order):
+            for child in trie[order[i]].values():
+                new[child] = len(order)
+                order.append(child)
+            i += 1
+        edges, wild, term, labels, targets = array("I", [0]), array("I"), array("I"), bytearray(), array("I")
+        height, jump, hops = array("I", [0] * len(order)), array("I", [0] * len(order)), array("I", [0] * len(order))
+        for node in order:
+            for byte in sorted(b for b in trie[node] if b is not None):
+                labels.append(byte)
+                targets.append(new[trie[node][byte]])
+            edges.append(len(labels))
+            wild.append(new[trie[node][None]] if None in trie[node] else 0)
+            term.append(terms[node] + 1 if node in terms else 0)
+        # children come after their parent in breadth-first order, hence heights and jumps are computed in reverse order
+        for node in reversed(order):
+            n = new[node]
+            for child in trie[node].values():
+                height[n] = max(height[n], height[new[child]] + 1)
+            if list(trie[node]) == [None] and node not in terms:
+                c = new[trie[node][None]]
+                jump[n], hops[n] = (jump[c], hops[c] + 1) if jump[c] else (c, 1)
+        variants, sources, strings, offsets, blob = array("I"), array("I"), {}, array("I", [0]), bytearray()
+        def _string(s):
+            if s not in strings:
+                strings[s] = len(strings)
+                blob.extend(s.encode("utf-8"))
+                offsets.append(len(blob))
+            return strings[s]
+        for name, origin in zip(names, origins):
+            for author, version in VARIANTS:
+                variants.append(_string(normalize(name, author, version)))
+            sources.append(_string(origin))
+        data = [HEADER.pack(MAGIC, VERSION, max_depth, len(order), len(labels), len(names), len(strings), *source)]
+        for a in [edges, wild, term, height, jump, hops, labels, targets, variants, sources, offsets, blob]:
+            a = bytes(a)
+            data.append(a + b"\0" * (-len(a) % 4))
+        return b"".join(data)
+    
+    @classmethod
+    def load(cls, path):
+        """ Memory-map a compiled index from the given path. """
+        from mmap import mmap, ACCESS_READ
+        with open(path, 'rb') as f:
+            return cls(mmap(f.fileno(), 0, access=ACCESS_READ))
+    
+    def match(self, kind, window, matches):
+        """ Walk the subtree of the given kind with a bytes sequence, appending the indices of the matching signatures
+             to matches.
+        
+        The walk is iterative : the exact bytes are followed as far as possible after the wildcard branch of each node,
+         whose continuation is stacked, hence the signatures are reported in depth-first order. Runs of wildcards are
+         skipped at once (see jump) and the window is never copied.
+        """
+        edges, wild, term, jump, hops, targets, labels = \
+            self._edges, self._wild, self._term, self._jump, self._hops, self._targets, self._labels
+        find, n, stack = self._buffer.find, len(window), [(KINDS.index(kind) + 1, 0)]
+        while stack:
+            node, i = stack.pop()
+            while True:
+                if term[node]:
+                    matches.append(term[node] - 1)
+                if i >= n:
+                    break
+                if jump[node]:
+                    node, i = jump[node], i + hops[node]
+                    if i > n:
+                        break
+                    continue
+                j = find(BYTE[window[i]], labels + edges[node], labels + edges[node+1])
+                if wild[node]:
+                    # explore the wildcard branch first, then the exact byte
+                    if j >= 0:
+                        stack.append((targets[j - labels], i + 1))
+                    node, i = wild[node], i + 1
+                elif j >= 0:
+                    node, i = targets[j - labels], i + 1
+                else:
+                    break
+        return matches
+    
+    def find(self, kind, signature):
+        """ Get the index of the signature of the given kind with exactly the given bytes (list of hexadecimal tokens
+             including "??" for wildcards), or None. """
+        node, find = KINDS.index(kind) + 1, self._buffer.find
+        for b in signature:
+            if b == "??":
+                node = self._wild[node]
+            elif b in BYTES:
+                j = find(BYTE[BYTES[b]], self._labels + self._edges[node], self._labels + self._edges[node+1])
+                node = self._targets[j - self._labels] if j >= 0 else 0
+            else:
+                return
+            if node == 0:
+                return
+        return self._term[node] - 1 if self._term[node] else None
+    
+    def generalizations(self, kind, signature):
+        """ Get the indices of the signatures of the given kind that match every window matched by the given signature
+             (list of hexadecimal tokens including "??" for wildcards), that is, the ones having, at each of their
+             positions, either "??" or the same byte as the signature (itself included if it is in the index). """
+        edges, wild, term, targets, labels = self._edges, self._wild, self._term, self._targets, self._labels
+        find, n, stack, found = self._buffer.find, len(signature), [(KINDS.index(kind) + 1, 0)], []
+        while stack:
+            node, i = stack.pop()
+            if term[node]:
+                found.append(term[node] - 1)
+            if i >= n:
+                continue
+            if wild[node]:
+                stack.append((wild[node], i + 1))
+            if signature[i] in BYTES and (j := find(BYTE[BYTES[signature[i]]], labels + edges[node],
+                                                    labels + edges[node+1])) >= 0:
+                stack.append((targets[j - labels], i + 1))
+        return found
+    
+    def first(self, kind, window):
+        """ Search the subtree of the given kind for the matching signature with the highest priority, that is, the
+             longest one, then the one with the most literal bytes, returning its index or None.
+        
+        The search is depth-first, trying exact bytes before wildcards (ties are resolved in favor of the first
+         signature found), and prunes the subtrees that cannot lead to a signature with a higher priority than the best
+         one found so far (see the height of the nodes).
+        """
+        return self._first(kind, window)[2]
+    
+    def _first(self, kind, window, excluded=()):
+        """ Search for the matching signature with the highest priority (see first), ignoring the excluded indices, and
+             return (length, number of literal bytes, index), index being None if there is no match. """
+        edges, wild, term, height, jump, hops, targets, labels = \
+            self._edges, self._wild, self._term, self._height, self._jump, self._hops, self._targets, self._labels
+        find, n, best = self._buffer.find, len(window), (-1, -1, None)
+        # stack of (node, number of bytes consumed, number of literal bytes consumed)
+        stack = [(KINDS.index(kind) + 1, 0, 0)]
+        while stack:
+            node, i, literals = stack.pop()
+            if term[node] and (i, literals) > best[:2] and term[node] - 1 not in excluded:
+                best = (i, literals, term[node] - 1)
+            # even if all the remaining bytes were literal, the subtree could not beat the best signature
+            h = min(height[node], n - i)
+            if h == 0 or (i + h, literals + h) <= best[:2]:
+                continue
+            if jump[node]:
+                if i + hops[node] <= n:
+                    stack.append((jump[node], i + hops[node], literals))
+                continue
+            if wild[node]:
+                stack.append((wild[node], i + 1, literals))
+            j = find(BYTE[window[i]], labels + edges[node], labels + edges[node+1])
+            if j >= 0:
+                stack.append((targets[j - labels], i + 1, literals + 1))
+        return best
+    
+    def name(self, idx, variant=0):
+        """ Get the name of the signature with the given index, in the given variant (index in VARIANTS). """
+        return self.__string(self._names[idx * 4 + variant])
+    
+    def origin(self, idx):
+        """ Get the database the signature with the given index comes from. """
+        return self.__string(self._origins[idx])
+    
+    def __string(self, s):
+        try:
+            return self._cache[s]
+        except KeyError:
+            o, strings = self._blob, self._strings
+            n = self._cache[s] = bytes(self._buffer[o+strings[s]:o+strings[s+1]]).decode("utf-8")
+            return n
+    
+    def signatures(self, kind):
+        """ Rebuild the signatures (lists of bytes with None for wildcards) of the given kind with their indices. """
+        stack = [(KINDS.index(kind) + 1, [])]
+        while stack:
+            node, signature = stack.pop()
+            if self._term[node]:
+                yield signature, self._term[node] - 1
+            if self._wild[node]:
+                stack.append((self._wild[node], signature + [None]))
+            for j in range(self._edges[node], self._edges[node+1]):
+                stack.append((self._targets[j], signature + [self._buffer[self._labels+j]]))
+
@@ -0,0 +1,119 @@
+# -*- coding: UTF-8 -*-
+import os
+from hashlib import sha256
+
+from .index import Index
+
+
+__all__ = ["Journal", "JournaledIndex"]
+
+
+class Journal:
+    """ Journal of the edits applied to a compiled index since it was built (see SignaturesTree.update), stored next to
+         the index as JSON lines so that editing a database costs an append instead of a rebuild of its index.
+    
+    The first line holds the digest of the database the index was built from ({"base": digest}). Then come batches of
+     edits, each one being closed by the fingerprint of the database once edited ({"fingerprint": [size, mtime,
+     digest]}) : the index with the edits up to the last fingerprint is the index of the database in this state. An edit
+     either adds or renames a signature ({"set": [kind, bytes, name]}) or removes it ({"unset": [kind, bytes]}),
+     signatures being identified by their kind and their bytes.
+    """
+    def __init__(self, index_path):
+        self.path = index_path + ".journal"
+    
+    def append(self, base, edits, fingerprint):
+        """ Append a batch of edits ({(kind, bytes): name or None}) with the resulting fingerprint of the database,
+             starting a new journal if the current one does not apply to the given base index. """
+        from msgspec.json import encode
+        lines = [{'set': [k, " ".join(s), n]} if n is not None else {'unset': [k, " ".join(s)]}
+                 for (k, s), n in edits.items()]
+        lines.append({'fingerprint': [fingerprint[0], fingerprint[1], fingerprint[2].hex()]})
+        mode = 'ab' if self.read(base) is not None else 'wb'
+        if mode == 'wb':
+            lines.insert(0, {'base': base.source[2].hex()})
+        with open(self.path, mode) as f:
+            f.write(b"".join(encode(l) + b"\n" for l in lines))
+    
+    def read(self, base):
+        """ Read the edits ({(kind, bytes): name or None}, the last edit of a signature prevailing) up to the last
+             fingerprint, returned with it, or None if there is no journal for the given base index. Lines after the
+             last fingerprint (e.g. left by an interrupted append) are ignored. """
+        from msgspec import DecodeError
+        from msgspec.json import decode
+        edits, pending, fingerprint = {}, {}, None
+        try:
+            with open(self.path, 'rb') as f:
+                if decode(f.readline() or b"{}").get('base') != base.source[2].hex():
+                    return
+                for line in f:
+                    entry = decode(line)
+                    if 'fingerprint' in entry:
+                        size, mtime, digest = entry['fingerprint']
+                        edits.update(pending)
+                        pending, fingerprint = {}, (size, mtime, bytes.fromhex(digest))
+                    elif 'set' in entry:
+                        kind, signature, name = entry['set']
+                        pending[(kind, tuple(signature.split()))] = name
+                    else:
+                        kind, signature = entry['unset']
+                        pending[(kind, tuple(signature.split()))] = None
+        except (OSError, DecodeError, AttributeError, KeyError, TypeError, ValueError):
+            pass
+        if fingerprint is not None:
+            return edits, fingerprint
+    
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class JournaledIndex:
+    """ Compiled index with edits applied on top of it (see Journal), queried like an Index.
+    
+    The signatures removed or renamed by the edits are masked in the base index while the ones set are compiled into a
+     small index that is matched after the base index, the indices of its signatures following the ones of the base
+     index. source is the fingerprint of the database the edits bring the base index up to date with.
+    """
+    def __init__(self, base, edits, source, origin=""):
+        self.base, self.edits, self.source, self._n = base, edits, list(source), len(base)
+        self.masked = {i for kind, signature in edits if (i := base.find(kind, signature)) is not None}
+        self.delta = Index(Index.build((k, list(s), n, origin) for (k, s), n in edits.items() if n is not None))
+        self.max_depth = max(base.max_depth, self.delta.max_depth)
+        # the numbering of the signatures depends on the base index and on the edits, unlike the one of the index
+        #  compacted from the same database
+        h = sha256(base.source[2])
+        for (kind, signature), name in edits.items():
+            h.update(f"{kind}|{' '.join(signature)}|{name}\n".encode())
+        self.layout = h.digest()
+    
+    def __len__(self):
+        return self._n + len(self.delta)
+    
+    def first(self, kind, window):
+        """ Search both indices for the matching signature with the highest priority (see Index.first), the base index
+             prevailing in case of a tie. """
+        best, added = self.base._first(kind, window, self.masked), self.delta._first(kind, window)
+        return self._n + added[2] if added[2] is not None and added[:2] > best[:2] else best[2]
+    
+    def match(self, kind, window, matches):
+        n = len(matches)
+        self.base.match(kind, window, matches)
+        if len(self.masked) > 0:
+            matches[n:] = [i for i in matches[n:] if i not in self.masked]
+        matches.extend(self._n + i for i in self.delta.match(kind, window, []))
+        return matches
+    
+    def name(self, idx, variant=0):
+        return self.base.name(idx, variant) if idx < self._n else self.delta.name(idx - self._n, variant)
+    
+    def origin(self, idx):
+        return self.base.origin(idx) if idx < self._n else self.delta.origin(idx - self._n)
+    
+    def signatures(self, kind):
+        for signature, idx in self.base.signatures(kind):
+            if idx not in self.masked:
+                yield signature, idx
+        for signature, idx in self.delta.signatures(kind):
+            yield signature, self._n + idx
@@ -0,0 +1,82 @@
+# -*- coding: UTF-8 -*-
+import re
+from collections import namedtuple
+
+
+__all__ = ["normalize", "parse", "Signature"]
+
+
+_AUTHOR = re.compile(r"\s*\-(\-?\>|\s*by)\s*(.*)$")
+_VER = r"\s*([vV](ersion)?|R)?\s?(20)?\d{1,2}(\.[xX0-9]{1,3}([a-z]?\d)?){0,3}[a-zA-Z\+]?" \
+       r"(\s*\(?(\s*([Aa]lpha|[Bb]eta|final|lite|LITE|osCE|Demo|DEMO)){1,2}(\s*[a-z]?\d)?\)?)?"
+_VERSION = re.compile(r"^(.*?)\s+" + _VER + r"(\s*[-_\/\~]" + _VER + r"){0,3}(\s+\(unregistered\))?")
+_VERSION_NUMBER = re.compile(r"\s+\d+(\s+SE)?$")
+
+
+Signature = namedtuple("Signature", ["name", "signature", "trailing_wildcards", "ep_only", "sec_start_only", "line"])
+
+
+def normalize(name, author=True, version=True):
+    """ Normalize a signature name by stripping its author (e.g. "-> jsmith") and/or its version (e.g. "v1.2 beta"). """
+    if author:
+        name = _AUTHOR.sub("", name)
+    if version:
+        name = _VERSION_NUMBER.sub("", _VERSION.sub(r"\1", name))
+    return name
+
+
+def parse(path, encoding="utf-8", comments=None, logger=None):
+    """ Parse a PEiD signatures database line by line, lazily yielding its signatures.
+    
+    :param path:     path to the database
+    :param encoding: encoding of the database
+    :param comments: list to be filled with the header comments of the database (";"-starting lines before the first
+                      signature), if any
+    :param logger:   logger for reporting the discarded entries
+    :return:         generator of Signature tuples (name, list of bytes without the trailing "??" tokens, trailing
+                      "??" tokens as a string, ep_only, section_start_only, line number of the entry)
+    """
+    def _signature(entry):
+        name, tokens, ep_only, sec_start_only, lineno = entry
+        if ep_only is None or len(tokens) == 0:
+            if logger:
+                logger.warning(f"{path}:{lineno}: discarded incomplete signature '{name}'")
+            return
+        if ep_only == "true" and sec_start_only == "true":
+            raise ValueError(f"{path}:{lineno}: Bad signature ; ep_only and section_start_only are mutually exclusive")
+        # split the trailing "??" tokens, keeping at least one token for the signature
+        n = len(tokens)
+        while n > 1 and tokens[n-1] == "??":
+            n -= 1
+        return Signature(name, tokens[:n], "".join(" " + t for t in tokens[n:]), ep_only == "true",
+                         sec_start_only == "true", lineno)
+    
+    entry, key = None, None
+    with open(path, encoding=encoding) as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if line.startswith(";"):
+                if entry is None and comments is not None:
+                    comments.append(line)
+                continue
+            if line.startswith("[") and line.endswith("]"):
+                if entry is not None and (sig := _signature(entry)):
+                    yield sig
+                # entry: [name, signature tokens, ep_only, section_start_only, line number]
+                entry, key = [line[1:-1], [], None, None, lineno], None
+                continue
+            if entry is None or line == "":
+                continue
+            k, sep, v = line.partition("=")
+            k = k.strip()
+            if sep and k in ["signature", "ep_only", "section_start_only"]:
+                key, v = k, v.strip()
+                if key == "signature":
+                    entry[1].extend(v.split())
+                else:
+                    entry[2 if key == "ep_only" else 3] = v.split()[0] if v else ""
+            elif key == "signature":
+                # the signature spans multiple lines
+                entry[1].extend(line.split())
+    if entry is not None and (sig := _signature(entry)):
+        yield sig
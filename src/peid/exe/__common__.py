@@ -1,20 +1,31 @@
 # -*- coding: UTF-8 -*-
-import _io
-from os.path import getsize
+from .reader import open_reader, BufferReader
 
 
 __all__ = ["EXE"]
 
 
 class EXE:
-    def __init__(self, path_or_buffer, logger=None):
-        self.logger = logger
-        self._fd = path_or_buffer if isinstance(path_or_buffer, _io.BufferedReader) else open(path_or_buffer, "rb")
-        self.path = self._fd.name
-        self.size = getsize(self.path)
-        if self._fd.read(2) != b"MZ":
+    """ Executable reader ; when use_mmap is True, the file is memory-mapped and the read windows are memoryviews on the
+         mapping, so that no byte of the sample gets copied.
+    
+    The executable can be given as a path, an opened file, any seekable file-like object (e.g. io.BytesIO), an
+     in-memory buffer (bytes, bytearray or memoryview), which is then used like a mapping, or a range reader (see
+     peid.exe.reader). Only the headers (one read) and the requested windows (one read per group of close windows) are
+     fetched, so that reading from a slow storage costs a few round trips per sample. File-like objects other than
+     opened files (io.BufferedReader) are left open when closing the executable.
+    """
+    def __init__(self, path_or_buffer, logger=None, use_mmap=False):
+        self.logger, self.buffer = logger, None
+        self._file = self._reader = open_reader(path_or_buffer)
+        self.path, self.size = self._reader.name, self._reader.size
+        self._header = self._reader.header
+        if self._header[:2] != b"MZ":
             raise OSError("Invalid MZ signature")
-        self._fd.seek(0)
+        if isinstance(self._reader, BufferReader):
+            self.buffer = self._reader.view
+        elif use_mmap:
+            self._map()
     
     def __enter__(self):
         return self
@@ -22,25 +33,43 @@ class EXE:
     def __exit__(self, type, value, traceback):
         self.close()
     
-    def close(self):
-        self._fd.close()
+    def _map(self):
+        """ Memory-map the file ; formats call it once their headers are parsed, so that no mapping is left open when
+             the parsing fails. """
+        from mmap import mmap, ACCESS_READ
+        if self.buffer is not None:
+            return
+        try:
+            self._reader = BufferReader(mmap(self._file.fileno(), 0, access=ACCESS_READ), self.path)
+            self.buffer = self._reader.view
+        except (AttributeError, OSError, ValueError) as e:
+            if self.logger:
+                self.logger.debug(f"Could not memory-map {self.path}: {e}")
     
-    def itersections(self):
-        for i in range(self.number_of_sections):
-            self._fd.seek(self.pe_offset + 24 + self.size_of_opt_header + i * 40 + 8)
-            virtual_size = int.from_bytes(self._fd.read(4), "little")
-            virtual_addr = int.from_bytes(self._fd.read(4), "little")
-            raw_size     = int.from_bytes(self._fd.read(4), "little")
-            raw_pointer  = int.from_bytes(self._fd.read(4), "little")
-            yield virtual_size, virtual_addr, raw_size, raw_pointer
+    def chunks(self, size=1 << 20):
+        for o in range(0, self.size, size):
+            yield self._reader.read_at(o, size)
+    
+    def close(self):
+        if self._reader is not self._file:
+            self._reader.close()
+        self._file.close()
     
     def read(self, n=64, *offsets):
         if len(offsets) == 0:
-            offsets = range(0, self.size-n)
-        for o in offsets:
-            self._fd.seek(o)
-            r = self._fd.read(min(n, self.size-o))
+            windows = (self._reader.read_at(o, n) for o in range(0, self.size-n))
+        else:
+            ranges, h = [(o, min(n, self.size-o)) for o in offsets], len(self._header)
+            # windows lying in the headers already read cost no read
+            fetched = iter(self._reader.read_many([(o, k) for o, k in ranges if o + k > h]))
+            windows = (self._header[o:o+k] if o + k <= h else next(fetched) for o, k in ranges)
+        for r in windows:
             if self.logger:
                 self.logger.debug(" ".join(f"{b:02X}" for b in r))
             yield r
-
+    
+    def read_at(self, offset, n):
+        """ Read n bytes at the given offset, from the headers already read if possible. """
+        if offset + n <= len(self._header):
+            return self._header[offset:offset+n]
+        return self._reader.read_at(offset, n)
@@ -1,17 +1,25 @@
 # -*- coding: UTF-8 -*-
 from .msdos import MSDOS
 from .pe import PE
+from .reader import open_reader, Reader
 
 
-__all__ = ["open_exe", "MSDOS", "PE"]
+__all__ = ["open_exe", "MSDOS", "PE", "Reader"]
 
 
-def open_exe(path_or_buffer, logger=None):
+def open_exe(path_or_buffer, logger=None, use_mmap=False):
     """ Find a matching format and return the instantiated executable object. """
-    for fmt in [PE, MSDOS]:
-        try:
-            return fmt(path_or_buffer, logger)
-        except OSError:
-            pass
-    raise OSError("Not a valid executable or supported executable format")
+    # the sample is opened (and its headers are read) only once for all the formats
+    reader = open_reader(path_or_buffer)
+    try:
+        for fmt in [PE, MSDOS]:
+            try:
+                return fmt(reader, logger, use_mmap)
+            except OSError:
+                pass
+        raise OSError("Not a valid executable or supported executable format")
+    except Exception:
+        if reader is not path_or_buffer:
+            reader.close()
+        raise
 
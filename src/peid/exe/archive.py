@@ -0,0 +1,199 @@
+# -*- coding: UTF-8 -*-
+import io
+import os
+import struct
+import tarfile
+import zipfile
+from collections import OrderedDict
+from threading import Lock
+
+from .reader import open_reader, FileReader, Reader, SliceReader, SEP
+
+
+__all__ = ["expand", "is_archive", "open_member", "Archive", "SEP"]
+
+
+CACHE_SIZE = 16
+COMPRESSED = (b"\x1f\x8b", b"BZh", b"\xfd7zXZ\x00")
+# errors of archives or members that cannot be read (e.g. corrupted, encrypted or with an unsupported compression)
+ERRORS = (OSError, ValueError, EOFError, RuntimeError, NotImplementedError, tarfile.TarError, zipfile.BadZipFile)
+ZIP = (b"PK\x03\x04", b"PK\x05\x06")
+ZIP_LOCAL_HEADER = struct.Struct("<26xHH")
+
+_ARCHIVES, _ARCHIVES_LOCK = OrderedDict(), Lock()
+
+
+class _ReaderIO(io.RawIOBase):
+    """ Seekable file object on a reader, for opening archives with zipfile and tarfile. """
+    def __init__(self, reader):
+        self.reader, self.name, self._pos = reader, reader.name, 0
+    
+    def readable(self):
+        return True
+    
+    def readinto(self, b):
+        data = self.reader.read_at(self._pos, len(b))
+        b[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+    
+    def seek(self, offset, whence=os.SEEK_SET):
+        self._pos = max(0, [0, self._pos, self.reader.size][whence] + offset)
+        return self._pos
+    
+    def seekable(self):
+        return True
+    
+    def tell(self):
+        return self._pos
+
+
+class _Unreadable(Reader):
+    """ Reader for a member that cannot be opened, raising the error when read so that the member gets reported like
+         any other unreadable sample. """
+    def __init__(self, error, name):
+        self.error, self.name = error, name
+    
+    def read_at(self, offset, n):
+        raise self.error
+
+
+class Archive:
+    """ ZIP or TAR (possibly compressed) archive opened from a reader, giving readers on its members.
+    
+    Members that are stored as is (uncompressed ZIP members, members of uncompressed TAR archives) are read as ranges of
+     the archive, hence only their headers and the windows to be matched are read. Compressed members are decompressed
+     as a stream up to the windows to be matched, the latter being read by increasing offsets.
+    """
+    mtime = None
+    
+    def __init__(self, reader, name=None):
+        self.reader, self.name = reader, name or reader.name
+        header, self._io = reader.header, _ReaderIO(reader)
+        self._tar = self._zip = None
+        if header.startswith(ZIP):
+            self._zip = zipfile.ZipFile(self._io)
+            self.members = {i.filename: i for i in self._zip.infolist() if not i.is_dir()}
+        elif header[257:262] == b"ustar" or header.startswith(COMPRESSED):
+            try:
+                self._tar = tarfile.open(fileobj=self._io, mode="r:*")
+            except tarfile.ReadError:
+                raise ValueError("Not a supported archive") from None
+            self.members = {m.name: m for m in self._tar.getmembers() if m.isfile()}
+            # members of a compressed archive are ranges of the decompressed stream, shared by all the members
+            self._base = reader if self._tar.fileobj is self._io else \
+                FileReader(self._tar.fileobj, False, max((m.offset_data + m.size for m in self.members.values()),
+                                                         default=0))
+        else:
+            raise ValueError("Not a supported archive")
+    
+    def __iter__(self):
+        yield from self.members
+    
+    def open(self, member):
+        """ Get a reader on the given member. """
+        info, name = self.members[member], f"{self.name}{SEP}{member}"
+        if self._zip is not None:
+            if info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 1:
+                n, m = ZIP_LOCAL_HEADER.unpack(self.reader.read_at(info.header_offset, ZIP_LOCAL_HEADER.size))
+                return SliceReader(self.reader, info.header_offset + 30 + n + m, info.file_size, name)
+            return FileReader(self._zip.open(info), True, info.file_size, name)
+        if info.issparse():
+            return FileReader(self._tar.extractfile(info), True, info.size, name)
+        return SliceReader(self._base, info.offset_data, info.size, name)
+
+
+def _archive(name, parent=None, member=None):
+    """ Get the archive at the given path or, if parent is given, the archive being the given member of parent ; the
+         last archives used are kept open as the members of an archive are generally opened one after the other. """
+    with _ARCHIVES_LOCK:
+        mtime = os.stat(name).st_mtime_ns if parent is None else parent.mtime
+        if (a := _ARCHIVES.get(name)) is not None and a.mtime == mtime:
+            _ARCHIVES.move_to_end(name)
+            return a
+        reader = FileReader(open(name, 'rb')) if parent is None else parent.open(member)
+        try:
+            a = Archive(reader, name)
+        except Exception:
+            reader.close()
+            raise
+        a.mtime, _ARCHIVES[name] = mtime, a
+        while len(_ARCHIVES) > CACHE_SIZE:
+            _ARCHIVES.popitem(last=False)
+        return a
+
+
+def _is_archive(header):
+    return header.startswith(ZIP + COMPRESSED) or header[257:262] == b"ustar"
+
+
+def expand(paths_or_buffers, nested=True):
+    """ Replace the archives amongst the given executables with their members, recursively if nested.
+    
+    Members of the archives given as paths are yielded as member paths ("archive!member", see open_member) so that they
+     can be sent to other processes, those of in-memory or file-like archives are yielded as readers. Other items are
+     yielded as is.
+    """
+    def _open(archive, member):
+        try:
+            return archive.open(member)
+        except ERRORS as e:
+            return _Unreadable(e, f"{archive.name}{SEP}{member}")
+    def _members(archive, path):
+        for member in archive:
+            if nested:
+                try:
+                    with archive.open(member) as r:
+                        nested_archive = _is_archive(r.header) and \
+                            (_archive(f"{archive.name}{SEP}{member}", archive, member) if path else
+                             Archive(archive.open(member)))
+                except ERRORS:
+                    nested_archive = None
+                if nested_archive:
+                    yield from _members(nested_archive, path)
+                    continue
+            yield f"{archive.name}{SEP}{member}" if path else _open(archive, member)
+    for exe in paths_or_buffers:
+        path = isinstance(exe, (str, os.PathLike))
+        try:
+            if path:
+                archive = _archive(os.fspath(exe))
+            else:
+                reader = FileReader(exe, False) if hasattr(exe, "read") and not isinstance(exe, Reader) else \
+                         open_reader(exe)
+                archive = Archive(reader)
+        except ERRORS:
+            yield exe
+            continue
+        yield from _members(archive, path)
+
+
+def is_archive(path_or_buffer):
+    """ Tell whether the given path, file-like object or buffer looks like a ZIP or TAR (possibly compressed) archive.
+    """
+    reader = FileReader(path_or_buffer, False) if hasattr(path_or_buffer, "read") else open_reader(path_or_buffer)
+    try:
+        return _is_archive(reader.header)
+    finally:
+        if reader is not path_or_buffer:
+            reader.close()
+
+
+def open_member(path):
+    """ Get a reader on the member of an archive designated by a path of the form "archive!member", nested archives
+         being designated by chaining their members (e.g. "archive.zip!samples.tar.gz!sample.exe"). """
+    i = -1
+    while (i := path.find(SEP, i + 1)) > 0 and not os.path.isfile(path[:i]):
+        pass
+    if i < 0:
+        raise FileNotFoundError(f"No such archive member: '{path}'")
+    archive, member = _archive(path[:i]), path[i+1:]
+    while member not in archive.members:
+        # the member is inside a nested archive, whose name is the longest prefix being a member
+        for j in [j for j, c in enumerate(member) if c == SEP][::-1]:
+            if member[:j] in archive.members:
+                archive, member = _archive(f"{archive.name}{SEP}{member[:j]}", archive, member[:j]), member[j+1:]
+                break
+        else:
+            raise FileNotFoundError(f"No such archive member: '{path}'")
+    return archive.open(member)
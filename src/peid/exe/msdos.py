@@ -1,5 +1,6 @@
 # -*- coding: UTF-8 -*-
 import struct
+from functools import cached_property
 
 from .__common__ import EXE
 
@@ -8,17 +9,17 @@ __all__ = ["MSDOS"]
 
 
 class MSDOS(EXE):
-    def __init__(self, path_or_buffer, logger=None):
+    def __init__(self, path_or_buffer, logger=None, use_mmap=False):
         super().__init__(path_or_buffer, logger)
-        h = self._fd.read(64)
-        # read some header fields
-        self.bytes_last_page = struct.unpack("<H", h[2:4])[0] or 512
-        self.pages_in_file = struct.unpack("<H", h[4:6])[0]
-        self.number_relocations = struct.unpack("<H", h[6:8])[0]
-        self.header_paragraphs = struct.unpack("<H", h[8:10])[0]
-        self.initial_ip = struct.unpack("<H", h[20:22])[0]
-        self.initial_cs = struct.unpack("<H", h[22:24])[0]
-        self.relocation_table_offset = struct.unpack("<H", h[24:26])[0]
+        h = self._header[:64]
+        if len(h) < 26:
+            raise OSError("Truncated MS-DOS header")
+        # read some header fields at once
+        self.bytes_last_page, self.pages_in_file, self.number_relocations, self.header_paragraphs, self.initial_ip, \
+            self.initial_cs, self.relocation_table_offset = struct.unpack_from("<4H10x3H", h, 2)
+        self.bytes_last_page = self.bytes_last_page or 512
+        if use_mmap:
+            self._map()
     
     @property
     def entrypoint_offset(self):
@@ -32,12 +33,8 @@ class MSDOS(EXE):
     def header_size(self):
         return self.header_paragraphs * 16
     
-    @property
+    @cached_property
     def sections_offsets(self):
-        offsets = []
-        self._fd.seek(self.relocation_table_offset)
-        for _ in range(self.number_relocations):
-            segment, offset = struct.unpack("<HH", self._fd.read(4))
-            offsets.append((segment << 4) + offset)
-        return offsets
+        table = self.read_at(self.relocation_table_offset, 4 * self.number_relocations)
+        return [(segment << 4) + offset for segment, offset in struct.iter_unpack("<HH", table[:len(table)//4*4])]
 
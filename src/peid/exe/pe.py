@@ -1,5 +1,7 @@
 # -*- coding: UTF-8 -*-
 import builtins
+import struct
+from functools import cached_property
 
 from .__common__ import EXE
 
@@ -7,33 +9,51 @@ from .__common__ import EXE
 __all__ = ["PE"]
 
 
+COFF_HEADER = struct.Struct("<4sHHIIIHH")
+SECTION_HEADER = struct.Struct("<8sIIII16x")
+
+
 class MalformedPE(ValueError):
     __module__ = "builtins"
 builtins.MalformedPE = MalformedPE
 
 
 class PE(EXE):
-    def __init__(self, path_or_buffer, logger=None):
+    def __init__(self, path_or_buffer, logger=None, use_mmap=False):
         super().__init__(path_or_buffer, logger)
-        # go to PE header offset location and read the offset
-        self._fd.seek(60)
-        self.pe_offset = int.from_bytes(self._fd.read(4), "little")
-        # go to PE header and check PE signature
-        self._fd.seek(self.pe_offset)
-        if self._fd.read(4) != b"PE\x00\x00":
+        # headers are parsed from the bulk read of the first 4KB (see EXE), with one more read if they exceed it
+        h, base = self._header, 0
+        if len(h) < 64:
+            raise OSError("Invalid PE signature")
+        self.pe_offset = struct.unpack_from("<I", h, 60)[0]
+        if len(h) < self.pe_offset + COFF_HEADER.size:
+            if self.pe_offset + COFF_HEADER.size > self.size:
+                raise OSError("Invalid PE signature")
+            h, base = bytes(self.read_at(self.pe_offset, 4096)), self.pe_offset
+        o = self.pe_offset - base
+        signature, self.machine, self.number_of_sections, _, _, _, self.size_of_opt_header, self.characteristics = \
+            COFF_HEADER.unpack_from(h, o)
+        if signature != b"PE\x00\x00":
             raise OSError("Invalid PE signature")
-        # read NumberOfSections 
-        self._fd.seek(self.pe_offset + 6)
-        self.number_of_sections = int.from_bytes(self._fd.read(2), "little")
-        # read SizeOfOptionalHeader
-        self._fd.seek(self.pe_offset + 20)
-        self.size_of_opt_header = int.from_bytes(self._fd.read(2), "little")
+        # parse the optional header (PE32 or PE32+) and the section table, with one more read if they exceed the buffer
+        start = o + COFF_HEADER.size
+        end = start + self.size_of_opt_header + self.number_of_sections * SECTION_HEADER.size
+        if len(h) < max(end, start + 32):
+            h += bytes(self.read_at(base + len(h), max(end, start + 32) - len(h)))
+        # Magic and AddressOfEntryPoint are read at their fixed offsets, even if SizeOfOptionalHeader is too small to
+        #  hold them (tiny or malformed headers, as produced by some packers)
+        opt = h[start:start+32].ljust(32, b"\0")
+        self.magic, self.address_of_entrypoint = struct.unpack_from("<H14xI", opt)
+        self.image_base = struct.unpack_from(["<28xI", "<24xQ"][self.magic == 0x20b], opt)[0]
+        start += self.size_of_opt_header
+        n = min(self.number_of_sections, max(0, len(h) - start) // SECTION_HEADER.size)
+        self.sections = [SECTION_HEADER.unpack_from(h, start + i * SECTION_HEADER.size) for i in range(n)]
+        if use_mmap:
+            self._map()
     
-    @property
+    @cached_property
     def entrypoint_offset(self):
-        # EP is at byte 40 of the PE header (when image file)
-        self._fd.seek(self.pe_offset + 40)
-        ep = int.from_bytes(self._fd.read(4), "little")
+        ep = self.address_of_entrypoint
         if self.logger:
             self.logger.debug(f"Entry point: 0x{ep:08x}")
         for vsize, vaddr, rsize, raddr in self.itersections():
@@ -42,22 +62,15 @@ class PE(EXE):
                 if self.logger:
                     self.logger.debug(f"Entry point offset: {o}")
                 return o
-        self._fd.seek(0)
-        c = self._fd.read()
-        raise MalformedPE(f"Entry point (0x{ep:08x}) offset is outside sections (file size: 0x{len(c):08x})")
+        raise MalformedPE(f"Entry point (0x{ep:08x}) offset is outside sections (file size: 0x{self.size:08x})")
     
-    @property
+    @cached_property
     def sections_offsets(self):
-        # Section Headers Table starts after the Optional Header
-        start = self.pe_offset + 24 + self.size_of_opt_header
-        self._fd.seek(start)
-        # 40 bytes per section header entry
-        offsets = []
-        for i in range(self.number_of_sections):
-            if self.logger:
-                self._fd.seek(start + i * 40)
-                self.logger.debug(self._fd.read(8).rstrip(b"\0").decode("utf-8"))
-            self._fd.seek(start + i * 40 + 20)
-            offsets.append(int.from_bytes(self._fd.read(4), "little"))
-        return offsets
-
+        if self.logger:
+            for name, *_ in self.sections:
+                self.logger.debug(name.rstrip(b"\0").decode("utf-8", errors="replace"))
+        return [raddr for _, _, _, _, raddr in self.sections]
+    
+    def itersections(self):
+        for _, virtual_size, virtual_addr, raw_size, raw_pointer in self.sections:
+            yield virtual_size, virtual_addr, raw_size, raw_pointer
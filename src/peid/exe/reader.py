@@ -0,0 +1,137 @@
+# -*- coding: UTF-8 -*-
+import _io
+import os
+from functools import cached_property
+from threading import Lock
+
+
+__all__ = ["open_reader", "BufferReader", "FileReader", "Reader", "SliceReader"]
+
+
+GAP = 4096
+HEADER_SIZE = 4096
+SEP = "!"
+
+
+class Reader:
+    """ Range reader, the way executables are read ; subclasses implement read_at and set name and size, so that the
+         samples can be read from any storage (e.g. with HTTP range requests). """
+    name, size = "<reader>", 0
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, type, value, traceback):
+        self.close()
+    
+    @cached_property
+    def header(self):
+        """ First bytes of the sample, holding its headers in most cases, read once for all the parsers. """
+        return bytes(self.read_at(0, HEADER_SIZE))
+    
+    def close(self):
+        pass
+    
+    def read_at(self, offset, n):
+        """ Read (at most) n bytes at the given offset. """
+        raise NotImplementedError
+    
+    def read_many(self, ranges, gap=GAP):
+        """ Read (offset, n) ranges, coalescing the ones that overlap or are less than gap bytes apart so that each
+             group costs a single read_at, and return the windows in the order of the ranges. """
+        windows, groups = [None] * len(ranges), []
+        for i in sorted(range(len(ranges)), key=lambda i: ranges[i][0]):
+            o, n = ranges[i]
+            if len(groups) > 0 and o <= groups[-1][1] + gap:
+                groups[-1][1] = max(groups[-1][1], o + n)
+                groups[-1][2].append(i)
+            else:
+                groups.append([o, o + n, [i]])
+        for start, end, items in groups:
+            data = self.read_at(start, end - start)
+            for i in items:
+                o, n = ranges[i]
+                windows[i] = data[o-start:o-start+n]
+        return windows
+
+
+class BufferReader(Reader):
+    """ Reader for an in-memory buffer (bytes, bytearray, memoryview or mmap) ; windows are memoryviews on the buffer,
+         hence nothing gets copied and there is no need for coalescing reads. """
+    def __init__(self, buffer, name="<memory>"):
+        self.buffer, self.name = buffer, name
+        self.view = memoryview(buffer).cast("B")
+        self.size = len(self.view)
+    
+    def close(self):
+        try:
+            self.view.release()
+            if hasattr(self.buffer, "close"):
+                self.buffer.close()
+        except BufferError:  # windows are still referenced, the buffer is then closed when garbage-collected
+            pass
+    
+    def read_at(self, offset, n):
+        return self.view[offset:offset+max(0, n)]
+    
+    def read_many(self, ranges, gap=GAP):
+        return [self.read_at(o, n) for o, n in ranges]
+
+
+class FileReader(Reader):
+    """ Reader for a seekable binary file object, using a single pread per read when the file has a descriptor ; other
+         file objects are sought then read under a lock, so that readers sharing the same file object (e.g. the
+         members of a compressed archive) can be used from multiple threads. """
+    def __init__(self, f, close=True, size=None, name=None):
+        self.file, self._close, self._lock = f, close, Lock()
+        self.name = name or getattr(f, "name", "<stream>")
+        self.size = f.seek(0, os.SEEK_END) if size is None else size
+        self._pread = hasattr(os, "pread") and isinstance(f, _io.BufferedReader)
+    
+    def close(self):
+        if self._close:
+            self.file.close()
+    
+    def fileno(self):
+        return self.file.fileno()
+    
+    def read_at(self, offset, n):
+        if n <= 0 or offset >= self.size:
+            return b""
+        if self._pread:
+            return os.pread(self.file.fileno(), n, offset)
+        with self._lock:
+            self.file.seek(offset)
+            return self.file.read(n)
+
+
+class SliceReader(Reader):
+    """ Reader for a range of another reader (e.g. a member stored uncompressed in an archive), the reads being
+         delegated to it so that they still get coalesced. """
+    def __init__(self, reader, offset, size, name="<slice>"):
+        self.reader, self.offset, self.size, self.name = reader, offset, size, name
+    
+    def read_at(self, offset, n):
+        if (n := min(n, self.size - offset)) <= 0:
+            return b""
+        return self.reader.read_at(self.offset + offset, n)
+    
+    def read_many(self, ranges, gap=GAP):
+        return self.reader.read_many([(self.offset + o, max(0, min(n, self.size - o))) for o, n in ranges], gap)
+
+
+def open_reader(path_or_buffer):
+    """ Get a reader for a path, an opened file, a seekable file-like object, an in-memory buffer or a reader. Opened
+         files (io.BufferedReader) are closed with the reader, unlike other file-like objects. Paths of the form
+         "archive!member" designate members of (possibly nested) archives (see peid.exe.archive). """
+    if isinstance(path_or_buffer, (str, os.PathLike)) and SEP in (path := os.fspath(path_or_buffer)) and \
+       not os.path.exists(path):
+        from .archive import open_member
+        return open_member(path)
+    if isinstance(path_or_buffer, Reader):
+        return path_or_buffer
+    if isinstance(path_or_buffer, (bytes, bytearray, memoryview)):
+        return BufferReader(path_or_buffer)
+    if hasattr(path_or_buffer, "read"):
+        return FileReader(path_or_buffer, isinstance(path_or_buffer, _io.BufferedReader))
+    return FileReader(open(path_or_buffer, "rb"))